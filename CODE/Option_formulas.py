@@ -33,6 +33,9 @@ def BlackScholes(Spot, Strike, TTM, rate, div, Vol, IsCall):
     - float: The Black-Scholes price of the option.
     """
     
+    if np.ndim(TTM) > 0 or np.ndim(IsCall) > 0:  # Array of contracts, use the broadcasting kernel
+        return BlackScholesGreeks(Spot, Strike, TTM, rate, div, Vol, IsCall)['price']
+
     N = norm.cdf  # Standard normal cumulative distribution function
 
     if TTM > 0:  # Positive time to maturity
@@ -68,6 +71,9 @@ def BlackScholesDelta(Spot, Strike, TTM, rate, div, Vol, IsCall):
     - float: The Delta of the option.
     """
     
+    if np.ndim(TTM) > 0 or np.ndim(IsCall) > 0:  # Array of contracts, use the broadcasting kernel
+        return BlackScholesGreeks(Spot, Strike, TTM, rate, div, Vol, IsCall)['delta']
+
     if TTM > 0:  # Positive time to maturity
         # Calculation of d1 for Delta using Black-Scholes formula components
         d1 = (np.log(Spot/Strike) + (rate - div + Vol**2 / 2) * TTM) / (Vol * np.sqrt(TTM))
@@ -105,6 +111,9 @@ def BlackScholesGamma(Spot, Strike, TTM, rate, div, Vol):
     Returns:
     - float: The Gamma of the option.
     """
+    if np.ndim(TTM) > 0:  # Array of contracts, use the broadcasting kernel
+        return BlackScholesGreeks(Spot, Strike, TTM, rate, div, Vol, True)['gamma']
+
     if TTM > 0:  # Positive time to maturity
         d1 = (np.log(Spot/Strike) + (rate - div + Vol**2 / 2) * TTM) / (Vol * np.sqrt(TTM))
         N_prime = norm.pdf(d1)  # Value of the standard normal probability density function at d1
@@ -114,3 +123,63 @@ def BlackScholesGamma(Spot, Strike, TTM, rate, div, Vol):
         return 0  # Gamma approaches 0 as we reach expiration, assuming no drastic changes in underlying
 
 
+def BlackScholesGreeks(Spot, Strike, TTM, rate, div, Vol, IsCall):
+    """
+    Calculate the Black-Scholes price and Greeks for a whole book of options in one pass.
+
+    Every argument may be a scalar or an array and all of them are broadcast together,
+    so a (num_scenarios, 1) array of spots against (num_options,) arrays of contract
+    terms prices every option under every scenario in a single call. d1, d2 and the
+    normal cdf/pdf evaluations are shared by all the outputs. Options with TTM <= 0
+    are masked out and valued at intrinsic, with zero gamma, vega, theta and rho.
+
+    Args:
+    - Spot (float or array): Current price of the underlying asset.
+    - Strike (float or array): Strike price of the option.
+    - TTM (float or array): Time to maturity of the option, in years.
+    - rate (float or array): Risk-free interest rate, as a decimal.
+    - div (float or array): Dividend yield of the asset, as a decimal.
+    - Vol (float or array): Volatility of the asset's returns, as a decimal.
+    - IsCall (bool or array): True for call options, False for put options.
+
+    Returns:
+    - dict: 'price', 'delta', 'gamma', 'vega', 'theta' (per year of calendar time)
+      and 'rho', each an array with the broadcast shape of the inputs.
+    """
+    Spot, Strike, TTM, rate, div, Vol = (np.asarray(a, dtype=float) for a in (Spot, Strike, TTM, rate, div, Vol))
+
+    omega = np.where(IsCall, 1.0, -1.0)  # +1 for calls, -1 for puts
+    alive = TTM > 0
+
+    # Expired options get a dummy maturity so that the formulas below stay finite
+    T = np.where(alive, TTM, 1.0)
+    sqrt_T = np.sqrt(T)
+
+    d1 = (np.log(Spot/Strike) + (rate - div + Vol**2 / 2) * T) / (Vol * sqrt_T)
+    d2 = d1 - Vol * sqrt_T
+
+    div_disc = np.exp(-div * T)
+    rate_disc = np.exp(-rate * T)
+
+    N_d1 = norm.cdf(omega * d1)
+    N_d2 = norm.cdf(omega * d2)
+    n_d1 = norm.pdf(d1)
+
+    price = omega * (Spot * div_disc * N_d1 - Strike * rate_disc * N_d2)
+    delta = omega * div_disc * N_d1
+    gamma = n_d1 * div_disc / (Spot * Vol * sqrt_T)
+    vega = Spot * div_disc * n_d1 * sqrt_T
+    theta = -Spot * div_disc * n_d1 * Vol / (2 * sqrt_T) \
+            - omega * rate * Strike * rate_disc * N_d2 + omega * div * Spot * div_disc * N_d1
+    rho = omega * Strike * T * rate_disc * N_d2
+
+    # At or past maturity: intrinsic value and its delta
+    intrinsic = np.maximum(omega * (Spot - Strike), 0)
+    intrinsic_delta = np.where(omega * (Spot - Strike) > 0, omega, 0.0)
+
+    return {'price': np.where(alive, price, intrinsic),
+            'delta': np.where(alive, delta, intrinsic_delta),
+            'gamma': np.where(alive, gamma, 0.0),
+            'vega': np.where(alive, vega, 0.0),
+            'theta': np.where(alive, theta, 0.0),
+            'rho': np.where(alive, rho, 0.0)}
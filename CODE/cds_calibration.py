@@ -0,0 +1,68 @@
+import torch
+import numpy as np
+import pandas as pd
+from pytorch_credit_curve import Credit_Curve, CDSBootstrapper
+from market_data import parse_percent, CDS_SPREAD_COLUMNS, CDS_SPREAD_MATURITIES, CDS_ID_COLUMNS
+
+
+def fill_missing_spreads(maturities, spreads):
+
+    # Missing tenors are linearly interpolated in maturity (flat beyond the quoted ones)
+    # so every name can be bootstrapped on the common pillars.
+    quoted = ~np.isnan(spreads)
+    filled = spreads.copy()
+
+    for i in np.flatnonzero(~quoted.all(axis=1) & quoted.any(axis=1)):
+        filled[i] = np.interp(maturities, maturities[quoted[i]], spreads[i, quoted[i]])
+
+    return filled, quoted
+
+
+def calibrate_cds_universe(path, ir_curve, pay_delta_t = 0.25, default_delta_t = 0.25, chunk_size = 2000,
+                           tol = 1e-14, max_iter = 50, raise_on_failure = False):
+
+    # Bootstraps the hazard curves of every row of a CDS_Data.csv like file. The file is
+    # streamed in chunks and every chunk is bootstrapped at once with the shared
+    # CDSBootstrapper (schedules and discount factors computed a single time).
+    # Returns the identifier columns, a (num_names, num_pillars) hazard rate matrix, a
+    # batched Credit_Curve over those hazards and a calibration report.
+    # Rows whose bootstrap does not converge at every pillar get nan hazards, so they
+    # cannot be used by mistake (report['failed'] flags the quoted ones); with
+    # raise_on_failure a ValueError naming them is raised instead.
+
+    maturities = np.array(CDS_SPREAD_MATURITIES, dtype=float)
+    bootstrapper = CDSBootstrapper(maturities, pay_delta_t, default_delta_t, ir_curve)
+
+    ids, lambdas, quoted, converged, failed = [], [], [], [], []
+
+    for chunk in pd.read_csv(path, sep=';', chunksize=chunk_size, usecols=CDS_ID_COLUMNS + CDS_SPREAD_COLUMNS + ['Recovery']):
+
+        spreads = np.column_stack([parse_percent(chunk[c]) for c in CDS_SPREAD_COLUMNS])
+        recovery = parse_percent(chunk['Recovery'])
+
+        spreads, chunk_quoted = fill_missing_spreads(maturities, spreads)
+
+        chunk_lambdas, report = bootstrapper.fit(spreads, recovery, tol = tol, max_iter = max_iter)
+
+        chunk_converged = report['converged'].all(axis=1)
+        chunk_failed = chunk_quoted.any(axis=1) & ~chunk_converged
+
+        if raise_on_failure and np.any(chunk_failed):
+            names = chunk[CDS_ID_COLUMNS[1:]][chunk_failed].astype(str).agg(' '.join, axis=1)
+            raise ValueError('CDS bootstrap did not converge for ' + ', '.join(names))
+
+        chunk_lambdas[~chunk_converged] = np.nan
+
+        ids.append(chunk[CDS_ID_COLUMNS])
+        lambdas.append(chunk_lambdas)
+        quoted.append(chunk_quoted)
+        converged.append(chunk_converged)
+        failed.append(chunk_failed)
+
+    lambdas = np.concatenate(lambdas)
+
+    credit_curves = Credit_Curve(torch.tensor(maturities), torch.tensor(lambdas))
+
+    return pd.concat(ids, ignore_index=True), lambdas, credit_curves, {'quoted': np.concatenate(quoted),
+                                                                        'converged': np.concatenate(converged),
+                                                                        'failed': np.concatenate(failed)}
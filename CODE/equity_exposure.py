@@ -0,0 +1,84 @@
+import numpy as np
+
+
+class CorrelatedGBM:
+
+    def __init__(self, spots, vols, correl, rate, div = 0.0):
+
+        # Risk neutral GBM for several assets whose Brownian motions are correlated
+        # through the Cholesky factor of correl.
+
+        self.spots = np.asarray(spots, dtype = float)
+        self.vols = np.asarray(vols, dtype = float)
+        self.correl = np.asarray(correl, dtype = float)
+        self.rate = rate
+        self.div = np.asarray(div, dtype = float)
+
+        self.chol = np.linalg.cholesky(self.correl)
+
+    def paths(self, time_grid, num_sims, chunk_steps = 10, rng = None):
+
+        # Generator over the time grid in chunks of chunk_steps dates. Each item is
+        # (times, S) with S of shape (num_sims, len(times), num_assets); the first chunk
+        # starts with the spot at time_grid[0]. Only the last log price of every path is
+        # carried between chunks, so the full path cube is never held in memory.
+
+        if rng is None:
+            rng = np.random.default_rng()
+
+        time_grid = np.asarray(time_grid, dtype = float)
+        num_assets = len(self.spots)
+
+        drift = self.rate - self.div - 0.5*self.vols**2
+
+        log_s = np.broadcast_to(np.log(self.spots), (num_sims, num_assets)).copy()
+
+        yield time_grid[:1], np.exp(log_s)[:, None, :]
+
+        for start in range(1, len(time_grid), chunk_steps):
+
+            end = min(start + chunk_steps, len(time_grid))
+            delta_t = (time_grid[start:end] - time_grid[start-1:end-1])[None, :, None]
+
+            brownian = rng.standard_normal((num_sims, end - start, num_assets)) @ self.chol.T
+
+            log_increments = drift*delta_t + self.vols*np.sqrt(delta_t)*brownian
+
+            log_paths = log_s[:, None, :] + np.cumsum(log_increments, axis = 1)
+            log_s = log_paths[:, -1, :]
+
+            yield time_grid[start:end], np.exp(log_paths)
+
+
+def simulate_exposure(model, pricer, time_grid, num_sims, quantiles = (95,), chunk_steps = 10, rng = None):
+
+    # Exposure profile of a portfolio under a path generator such as CorrelatedGBM.
+    # pricer(t, S) values the portfolio on a chunk: t has shape (num_dates,), S has shape
+    # (num_sims, num_dates, num_assets) and the result is (num_sims, num_dates). Since a
+    # chunk holds every path for its dates, EE, EPE and the PFE quantiles are exact and
+    # accumulated date by date without keeping the NPV matrix.
+
+    time_grid = np.asarray(time_grid, dtype = float)
+
+    EE = np.zeros(len(time_grid))
+    EPE = np.zeros(len(time_grid))
+    PFE = {q: np.zeros(len(time_grid)) for q in quantiles}
+
+    position = 0
+
+    for times, S in model.paths(time_grid, num_sims, chunk_steps, rng):
+
+        values = pricer(times, S)
+        exposure = np.maximum(values, 0)
+
+        dates = slice(position, position + len(times))
+
+        EE[dates] = np.mean(values, axis = 0)
+        EPE[dates] = np.mean(exposure, axis = 0)
+
+        for q, pfe in zip(quantiles, np.percentile(exposure, q = quantiles, axis = 0)):
+            PFE[q][dates] = pfe
+
+        position += len(times)
+
+    return {'time_grid': time_grid, 'EE': EE, 'EPE': EPE, 'PFE': PFE}
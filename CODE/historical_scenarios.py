@@ -0,0 +1,185 @@
+import numpy as np
+import pandas as pd
+import torch
+import risk_metrics
+
+
+class HistoricalScenarioGenerator:
+
+    def __init__(self, history, shift_types = 'relative', initial_window = 30):
+
+        # Historical simulation scenarios from a history of risk factor levels, a
+        # (num_dates, num_factors) array, a DataFrame or a market_data.TimeSeriesTable.
+        # A 1-D array or a Series is a single factor.
+        # shift_types, one per factor (list or dict by column) or one for all:
+        #   'relative'  shocked = base * X[t+h] / X[t]   (spots)
+        #   'absolute'  shocked = base + X[t+h] - X[t]   (vols, rates)
+        # Shifts are kept in a transformed space (log levels for relative factors, levels
+        # for absolute ones), where every horizon is a plain difference, and cached by
+        # horizon so 1, 10 and 20 day runs and their variants share the work.
+
+        if isinstance(history, pd.Series):
+            history = history.to_frame()
+
+        if isinstance(history, pd.DataFrame):
+            self.dates = history.index.to_numpy()
+            self.columns = [str(c) for c in history.columns]
+            values = history.to_numpy(dtype = float)
+        elif hasattr(history, 'dates'):
+            self.dates = np.asarray(history.dates)
+            self.columns = list(history.columns)
+            values = np.asarray(history.values, dtype = float)
+        else:
+            values = np.asarray(history, dtype = float)
+
+            if values.ndim == 1:
+                values = values[:, None]
+            elif values.ndim != 2:
+                raise ValueError('history must be (num_dates, num_factors), got shape ' + str(values.shape))
+
+            self.dates = np.arange(values.shape[0])
+            self.columns = [str(i) for i in range(values.shape[1])]
+
+        if isinstance(shift_types, str):
+            shift_types = [shift_types] * values.shape[1]
+        elif isinstance(shift_types, dict):
+            shift_types = [shift_types.get(c, 'relative') for c in self.columns]
+
+        if any(s not in ('relative', 'absolute') for s in shift_types):
+            raise ValueError('Shift types must be relative or absolute')
+
+        self.shift_types = list(shift_types)
+        self.relative = np.array([s == 'relative' for s in shift_types])
+
+        self.levels = np.where(self.relative, np.log(np.where(self.relative, values, 1.0)), values)
+
+        self.initial_window = initial_window
+
+        self.shift_cache = {}
+        self.variance_cache = {}
+
+    def num_scenarios(self, horizon):
+        return self.levels.shape[0] - horizon
+
+    def shifts(self, horizon):
+
+        # Overlapping horizon-day shifts in transformed space, (num_scenarios, num_factors)
+        if horizon not in self.shift_cache:
+            self.shift_cache[horizon] = self.levels[horizon:] - self.levels[:-horizon]
+
+        return self.shift_cache[horizon]
+
+    def ewma_variance(self, lam = 0.94):
+
+        # EWMA forecasts of the daily variance of every factor: row k is the forecast for
+        # the shift from date k to k+1, the last row the forecast for the next day.
+        if lam not in self.variance_cache:
+
+            daily = self.shifts(1)
+
+            variance = np.zeros((daily.shape[0] + 1, daily.shape[1]))
+            variance[0] = np.mean(daily[:self.initial_window]**2, axis = 0)
+
+            for k in range(daily.shape[0]):
+                variance[k+1] = lam*variance[k] + (1-lam)*daily[k]**2
+
+            self.variance_cache[lam] = variance
+
+        return self.variance_cache[lam]
+
+    def scaling_factors(self, horizon, scaling = None, lam = 0.94):
+
+        # Filtered historical simulation with an EWMA filter (Hull and White volatility
+        # weighting): each scenario is rescaled by current vol / vol at the start of its window
+        if scaling is None:
+            return None
+
+        if scaling != 'ewma':
+            raise ValueError('Unknown scaling ' + str(scaling))
+
+        variance = self.ewma_variance(lam)
+
+        return np.sqrt(variance[-1] / variance[:self.num_scenarios(horizon)])
+
+    def weights(self, horizon, scheme = 'equal', lam = 0.98):
+
+        # Probability of every scenario (summing to one), oldest first.
+        # 'age': Boudoukh-Richardson-Whitelaw weights, decaying by lam per day of age.
+        n = self.num_scenarios(horizon)
+
+        if scheme == 'equal':
+            return np.full(n, 1.0 / n)
+
+        if scheme == 'age':
+            w = lam ** np.arange(n - 1, -1, -1, dtype = float)
+            return w / w.sum()
+
+        raise ValueError('Unknown weighting scheme ' + str(scheme))
+
+    def apply(self, base_scenario, shifts):
+
+        base_scenario = np.asarray(base_scenario, dtype = float).reshape(1, -1)
+
+        return np.where(self.relative, base_scenario*np.exp(shifts), base_scenario + shifts)
+
+    def scenarios(self, base_scenario, horizon, scaling = None, lam = 0.94):
+
+        return next(self.iter_scenarios(base_scenario, horizon, None, scaling, lam))
+
+    def iter_scenarios(self, base_scenario, horizon, chunk_size = 10000, scaling = None, lam = 0.94):
+
+        # Shocked scenarios in chunks of chunk_size rows (all at once for None). Only the
+        # current chunk is materialized; it can be passed straight to
+        # Portfolio_Delta_NPV_Calculator.compute_scenarios_pl_chunked.
+        shifts = self.shifts(horizon)
+        scale = self.scaling_factors(horizon, scaling, lam)
+
+        n = shifts.shape[0]
+        chunk_size = n if chunk_size is None else chunk_size
+
+        for start in range(0, n, chunk_size):
+
+            chunk = shifts[start:start + chunk_size]
+
+            if scale is not None:
+                chunk = chunk * scale[start:start + chunk_size]
+
+            yield self.apply(base_scenario, chunk)
+
+    def report(self, calculator, base_scenario, horizons = (1, 10, 20), alphas = (0.99,),
+               weightings = None, scalings = (None,), day_fraction = 0.0, chunk_size = 10000):
+
+        # VaR / ES (losses as positive numbers) for every horizon, scenario scaling and
+        # weighting scheme. The P&L vector is computed once per (horizon, scaling) and
+        # reused by all the weighting schemes, which only change the probabilities.
+        # weightings maps a label to the keyword arguments of weights, e.g.
+        # {'equal': {}, 'age 0.98': {'scheme': 'age', 'lam': 0.98}}, equal weights only by default.
+        # day_fraction ages the portfolio by horizon * day_fraction (0 values at base time).
+
+        if weightings is None:
+            weightings = {'equal': {}}
+
+        rows = []
+
+        for horizon in horizons:
+            for scaling in scalings:
+
+                chunks = self.iter_scenarios(base_scenario, horizon, chunk_size, scaling)
+
+                pl = [chunk_pl for chunk_pl, _ in calculator.compute_scenarios_pl_chunked(base_scenario, horizon*day_fraction, chunks)]
+                pl = np.concatenate([x.detach().numpy() if torch.is_tensor(x) else np.asarray(x) for x in pl])
+
+                for label, options in weightings.items():
+
+                    weights = self.weights(horizon, **options)
+
+                    row = {'horizon': horizon, 'scaling': scaling or 'none', 'weighting': label}
+
+                    for alpha in alphas:
+                        var, es = risk_metrics.weighted_var_es(pl, weights, alpha)
+                        row['VaR ' + str(alpha)] = var
+                        row['ES ' + str(alpha)] = es
+
+                    rows.append(row)
+
+        return pd.DataFrame(rows)
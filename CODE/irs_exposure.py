@@ -1,4 +1,7 @@
 import numpy as np
+from collections import OrderedDict
+import risk_metrics
+import process_pools
 
 class IRS:
 
@@ -25,26 +28,67 @@ class IRS:
     pending_fix_payments = self.fix_pay_dates[self.fix_pay_dates > t]
     pending_year_frac = self.year_frac_fix[self.fix_pay_dates > t]
 
-    fix_leg_npv = 0
+    # All pending coupons are discounted at once. The last axis of disc runs over
+    # payment dates (leading axes, if any, run over simulated paths).
+    disc = IRCurve.DiscountFactor(t, pending_fix_payments)
 
-    for i in range(len(pending_fix_payments)):
-
-      disc = IRCurve.DiscountFactor(t, pending_fix_payments[i])
-
-      fix_leg_npv += disc*pending_year_frac[i]*self.fix_rate
+    fix_leg_npv = np.sum(disc*pending_year_frac*self.fix_rate, axis = -1)
 
     return fix_leg_npv - float_leg_npv
   
 
 class HWModel:
 
+  coef_cache_size = 256
+
   def __init__(self, init_curve, kappa, sigma):
 
+    self._coef_grid = None
+    self._coef_cache = OrderedDict()
+
     self.init_curve = init_curve
     self.kappa = kappa
     self.sigma = sigma
 
-  def DiscountFactor(self, t, T, x_t):
+  # The deterministic coefficients of the bond formula only depend on the model
+  # parameters, so any change to them invalidates the cached values.
+
+  @property
+  def init_curve(self):
+    return self._init_curve
+
+  @init_curve.setter
+  def init_curve(self, init_curve):
+    self._init_curve = init_curve
+    self.clear_cache()
+
+  @property
+  def kappa(self):
+    return self._kappa
+
+  @kappa.setter
+  def kappa(self, kappa):
+    self._kappa = kappa
+    self.clear_cache()
+
+  @property
+  def sigma(self):
+    return self._sigma
+
+  @sigma.setter
+  def sigma(self, sigma):
+    self._sigma = sigma
+    self.clear_cache()
+
+  def clear_cache(self):
+
+    self._coef_grid = None
+    self._coef_cache.clear()
+
+  def Coefficients(self, t, T):
+
+    # P(t,T) = A(t,T) * exp(-B(t,T) * x_t), with alpha_t already folded into A.
+    # t and T broadcast elementwise.
 
     B_t_T = (1-np.exp(-self.kappa*(T-t))) / self.kappa
 
@@ -59,17 +103,146 @@ class HWModel:
 
     alpha_t = f_0_t + self.sigma*self.sigma*(1-np.exp(-self.kappa*t))**2/(2*self.kappa*self.kappa)
 
-    r_t = x_t +  alpha_t
+    return A_t_T * np.exp(-B_t_T*alpha_t), B_t_T
+
+  def precompute(self, time_steps, pay_dates):
+
+    # Coefficients for every (simulation date, payment date) pair of a grid
+    time_steps = np.asarray(time_steps, dtype = float)
+    pay_dates = np.asarray(pay_dates, dtype = float)
+
+    A, B = self.Coefficients(time_steps[:,None], pay_dates[None,:])
+
+    self._coef_grid = (time_steps, pay_dates, A, B)
+
+  def get_coefficients(self, t, T):
+
+    if self._coef_grid is not None and np.ndim(t) == 0:
 
-    return A_t_T * np.exp(-B_t_T*r_t)
+      time_steps, pay_dates, A, B = self._coef_grid
 
-  def SimulProcess(self, t, T, x_t):
+      row = np.searchsorted(time_steps, t)
+      cols = np.searchsorted(pay_dates, T)
+
+      if row < len(time_steps) and time_steps[row] == t \
+        and np.all(cols < len(pay_dates)) and np.all(pay_dates[np.minimum(cols, len(pay_dates)-1)] == T):
+        return A[row, cols], B[row, cols]
+
+    # Off grid requests are memoized in a small LRU keyed by the time arrays
+    t_arr = np.asarray(t, dtype = float)
+    T_arr = np.asarray(T, dtype = float)
+    key = (t_arr.shape, t_arr.tobytes(), T_arr.shape, T_arr.tobytes())
+
+    if key in self._coef_cache:
+      self._coef_cache.move_to_end(key)
+      return self._coef_cache[key]
+
+    coefs = self.Coefficients(t, T)
+
+    self._coef_cache[key] = coefs
+    if len(self._coef_cache) > self.coef_cache_size:
+      self._coef_cache.popitem(last = False)
+
+    return coefs
+
+  def DiscountFactor(self, t, T, x_t):
+
+    A_t_T, B_t_T = self.get_coefficients(t, T)
+
+    return A_t_T * np.exp(-B_t_T*x_t)
+
+  def SimulProcess(self, t, T, x_t, rng = None):
 
     exp_val = x_t * np.exp(-self.kappa*(T-t))
 
     vol = self.sigma * np.sqrt((1-np.exp(-2*self.kappa*(T-t)))/(2*self.kappa))
 
-    return exp_val + vol*np.random.normal(0,1)
+    z = np.random.normal(0,1) if rng is None else rng.standard_normal()
+
+    return exp_val + vol*z
+
+  def SimulPaths(self, time_steps, num_sims, x_0 = 0, stream = None, start = 0):
+
+    # Exact OU transition between consecutive dates, one vectorized draw per
+    # date for all paths at once. Returns x_t with shape (num_sims, num_steps).
+    # With a random_streams.RandomStream the normals of paths start, ...,
+    # start + num_sims - 1 are taken from it, otherwise from np.random.
+
+    delta_t = np.diff(time_steps)
+
+    decay = np.exp(-self.kappa*delta_t)
+    vol = self.sigma * np.sqrt((1-np.exp(-2*self.kappa*delta_t))/(2*self.kappa))
+
+    if stream is None:
+      z = np.random.normal(0, 1, (len(delta_t), num_sims)).T
+    else:
+      z = stream.normals(time_steps, num_sims, start)
+
+    x = np.zeros((num_sims, len(time_steps)))
+    x[:,0] = x_0
+
+    for j in range(len(delta_t)):
+
+      x[:,j+1] = x[:,j]*decay[j] + vol[j]*z[:,j]
+
+    return x
+
+  def TransitionMoments(self, delta_t):
+
+    # Moments of (x_T, int_t^T x_s ds) given x_t, with delta_t = T - t:
+    # conditional means x_t * decay and x_t * B, and the covariance terms of the
+    # Gaussian innovations.
+
+    kappa, sigma = self.kappa, self.sigma
+
+    decay = np.exp(-kappa*delta_t)
+    B = -np.expm1(-kappa*delta_t) / kappa
+    B_2 = -np.expm1(-2*kappa*delta_t) / (2*kappa)
+
+    var_x = sigma*sigma*B_2
+    var_int = np.maximum(sigma*sigma/(kappa*kappa)*(delta_t - 2*B + B_2), 0)
+    cov = sigma*sigma/(2*kappa*kappa)*(1-decay)**2
+
+    return decay, B, var_x, var_int, cov
+
+  def IntegratedDrift(self, t):
+
+    # int_0^t alpha_s ds, such that exp(-int_0^t r_s ds) has expectation P(0,t)
+    _, _, _, var_int, _ = self.TransitionMoments(t)
+
+    return -np.log(self.init_curve.DiscountFactor(0,t)) + 0.5*var_int
+
+  def SimulPathsIntegrated(self, time_grid, num_sims, x_0 = 0, stream = None, start = 0):
+
+    # Exact joint simulation of x_t and int_{t_0}^t x_s ds on an arbitrary, possibly
+    # sparse, increasing grid: the pair is Gaussian given x at the previous date, so
+    # each step takes two normals per path whatever its length. Returns (x, int_x),
+    # both with shape (num_sims, len(time_grid)).
+
+    time_grid = np.asarray(time_grid, dtype = float)
+
+    decay, B, var_x, var_int, cov = self.TransitionMoments(np.diff(time_grid))
+
+    # Cholesky factor of the 2x2 innovation covariance of every step
+    vol_x = np.sqrt(var_x)
+    load = np.divide(cov, vol_x, out = np.zeros_like(cov), where = vol_x > 0)
+    vol_int = np.sqrt(np.maximum(var_int - load*load, 0))
+
+    if stream is None:
+      z = np.random.normal(0, 1, (2, len(decay), num_sims)).transpose(2, 0, 1)
+    else:
+      z = stream.normals(time_grid, num_sims, start, num_factors = 2)
+
+    x = np.zeros((num_sims, len(time_grid)))
+    int_x = np.zeros((num_sims, len(time_grid)))
+    x[:,0] = x_0
+
+    for j in range(len(decay)):
+
+      x[:,j+1] = x[:,j]*decay[j] + vol_x[j]*z[:,0,j]
+      int_x[:,j+1] = int_x[:,j] + x[:,j]*B[j] + load[j]*z[:,0,j] + vol_int[j]*z[:,1,j]
+
+    return x, int_x
 
   def get_rate(self, t, x_t):
 
@@ -79,6 +252,29 @@ class HWModel:
 
     return x_t +  alpha_t
   
+class ExposureSchedule:
+
+  def __init__(self, exposure_dates, portfolio = None, start = 0.0):
+
+    # Minimal simulation grid: the start date, the requested exposure dates and the
+    # portfolio cashflow dates up to the last exposure date. HWModel.SimulPathsIntegrated
+    # steps exactly between consecutive grid dates, so no intermediate dates are needed.
+
+    self.exposure_dates = np.unique(np.asarray(exposure_dates, dtype = float))
+
+    horizon = self.exposure_dates[-1]
+
+    if portfolio is None:
+      self.cashflow_dates = np.zeros(0)
+    else:
+      dates = portfolio.unique_dates
+      self.cashflow_dates = dates[(dates > start) & (dates <= horizon)]
+
+    self.grid = np.union1d(np.union1d([start], self.exposure_dates), self.cashflow_dates)
+
+    self.exposure_index = np.searchsorted(self.grid, self.exposure_dates)
+    self.cashflow_index = np.searchsorted(self.grid, self.cashflow_dates)
+
 class HWCurveWrapper:
 
     def __init__(self, HW):
@@ -88,7 +284,11 @@ class HWCurveWrapper:
 
     def DiscountFactor(self, t,T):
 
-        return self.HW.DiscountFactor(t,T,self.x)
+        # x may hold one state per path. When T is an array of payment dates the
+        # result is laid out as (paths, dates).
+        x = self.x if np.ndim(T) == 0 else np.expand_dims(self.x, -1)
+
+        return self.HW.DiscountFactor(t,T,x)
 
 
 class IRS_Portfolio:
@@ -97,16 +297,264 @@ class IRS_Portfolio:
 
     self.swap_list = swap_list
 
+    self.compile()
+
+  def compile(self):
+
+    # Flatten the fixed legs of every swap into contiguous arrays, ordered by
+    # trade, so pricing does not loop over swaps nor coupons.
+    # Elem 0 es nominal y elem 1 es objeto irs
+
+    if len(self.swap_list) == 0:
+      # Empty portfolio: no flows, every NPV is zero
+      self.notionals = self.maturities = np.zeros(0)
+      self.trade_index = self.trade_start = np.zeros(0, dtype = int)
+      self.pay_dates = self.year_fracs = self.fix_rates = self.fix_amounts = np.zeros(0)
+      self.unique_dates = self.date_weights = np.zeros(0)
+      self.flow_to_date = self.maturity_to_date = np.zeros(0, dtype = int)
+      return
+
+    self.notionals = np.array([irs[0] for irs in self.swap_list], dtype = float)
+    self.maturities = np.array([irs[1].fix_pay_dates[-1] for irs in self.swap_list], dtype = float)
+
+    num_flows = [len(irs[1].fix_pay_dates) for irs in self.swap_list]
+
+    self.trade_index = np.repeat(np.arange(len(self.swap_list)), num_flows)
+    self.trade_start = np.concatenate(([0], np.cumsum(num_flows)[:-1])).astype(int)
+
+    self.pay_dates = np.concatenate([irs[1].fix_pay_dates for irs in self.swap_list])
+    self.year_fracs = np.concatenate([irs[1].year_frac_fix for irs in self.swap_list])
+    self.fix_rates = np.repeat([irs[1].fix_rate for irs in self.swap_list], num_flows)
+
+    self.fix_amounts = self.notionals[self.trade_index]*self.year_fracs*self.fix_rates
+
+    # Deduplicated union of pay dates. The float leg of each trade (sustitucion
+    # por principales) pays its notional at maturity, which is also a fixed pay date.
+    self.unique_dates, self.flow_to_date = np.unique(self.pay_dates, return_inverse = True)
+    self.maturity_to_date = np.searchsorted(self.unique_dates, self.maturities)
+
+    self.date_weights = np.bincount(self.flow_to_date, weights = self.fix_amounts, minlength = len(self.unique_dates)) \
+                      + np.bincount(self.maturity_to_date, weights = self.notionals, minlength = len(self.unique_dates))
+
   def get_NPV(self, t, IRCurve):
 
-    npv = 0
+    pending = self.unique_dates > t
+
+    disc = IRCurve.DiscountFactor(t, self.unique_dates[pending])
+
+    return disc @ self.date_weights[pending] - np.sum(self.notionals[self.maturities > t])
+
+  def get_NPV_by_trade(self, t, IRCurve):
+
+    # Notional weighted NPV of every trade, last axis runs over trades
+    pending = self.unique_dates > t
+
+    disc = IRCurve.DiscountFactor(t, self.unique_dates[pending])
 
-    for irs in self.swap_list:
-      # Elem 0 es nominal y elem 1 es objeto irs
-      npv += irs[0]*irs[1].get_NPV(t, IRCurve)
+    disc_dates = np.zeros(disc.shape[:-1] + (len(self.unique_dates),))
+    disc_dates[..., pending] = disc
 
-    return npv
+    if len(self.swap_list) == 0:
+      return disc_dates
+
+    fix_leg_npv = np.add.reduceat(disc_dates[..., self.flow_to_date]*self.fix_amounts, self.trade_start, axis = -1)
+
+    alive = self.maturities > t
+    float_leg_npv = self.notionals*(1 - disc_dates[..., self.maturity_to_date])*alive
+
+    return fix_leg_npv - float_leg_npv
   
+class HWExposureEngine:
+
+  def __init__(self, HW, portfolio, time_steps, surv_curve, recovery):
+
+    self.HW = HW
+    self.portfolio = portfolio
+    self.time_steps = np.asarray(time_steps, dtype = float)
+    self.surv_curve = surv_curve
+    self.recovery = recovery
+
+    self.schedule = ExposureSchedule(self.time_steps, portfolio, self.time_steps[0])
+
+  def simulate_batch(self, num_sims, stream = None, start = 0):
+
+    # NPVs, short rates and numeraire of num_sims new paths, shape (num_sims, num_steps)
+
+    time_steps = self.time_steps
+
+    x = self.HW.SimulPaths(time_steps, num_sims, stream = stream, start = start)
+
+    rates = self.HW.get_rate(time_steps, x)
+
+    # Every path is priced at once on each exposure date
+    wrapper = HWCurveWrapper(self.HW)
+
+    NPVs = np.zeros((num_sims, len(time_steps)))
+
+    for j in range(len(time_steps)):
+
+      wrapper.x = x[:,j]
+      NPVs[:,j] = self.portfolio.get_NPV(time_steps[j], wrapper)
+
+    # Discrete bank account rolled with the simulated one period discount factors
+    one_period_df = self.HW.DiscountFactor(time_steps[:-1], time_steps[1:], x[:,:-1])
+
+    curr_acc = np.ones((num_sims, len(time_steps)))
+    curr_acc[:,1:] = np.cumprod(1/one_period_df, axis = 1)
+
+    return NPVs, rates, curr_acc
+
+  def simulate_exact_batch(self, num_sims, stream = None, start = 0):
+
+    # As simulate_batch, but the state is stepped exactly over the schedule grid and the
+    # numeraire is the bank account exp(int r_s ds) from the simulated integral of the
+    # short rate, so it is exact however sparse the exposure dates are. Also returns
+    # the numeraire on the cashflow dates of the schedule.
+
+    schedule = self.schedule
+    grid = schedule.grid
+
+    x, int_x = self.HW.SimulPathsIntegrated(grid, num_sims, stream = stream, start = start)
+
+    bank_account = np.exp(int_x + self.HW.IntegratedDrift(grid) - self.HW.IntegratedDrift(grid[0]))
+
+    x = x[:, schedule.exposure_index]
+    time_steps = self.time_steps
+
+    rates = self.HW.get_rate(time_steps, x)
+
+    wrapper = HWCurveWrapper(self.HW)
+
+    NPVs = np.zeros((num_sims, len(time_steps)))
+
+    for j in range(len(time_steps)):
+
+      wrapper.x = x[:,j]
+      NPVs[:,j] = self.portfolio.get_NPV(time_steps[j], wrapper)
+
+    return NPVs, rates, bank_account[:, schedule.exposure_index], bank_account[:, schedule.cashflow_index]
+
+  def run_exact(self, num_sims, pfe_quantile = 95, stream = None):
+
+    self.HW.precompute(self.time_steps, self.portfolio.unique_dates)
+
+    NPVs, rates, curr_acc, cashflow_acc = self.simulate_exact_batch(num_sims, stream)
+
+    result = self.summarize(NPVs, rates, curr_acc, pfe_quantile)
+    result['discounted_EPE'] = np.mean(np.maximum(NPVs,0) / curr_acc, axis = 0)
+    result['cashflow_dates'] = self.schedule.cashflow_dates
+    result['cashflow_numeraire'] = cashflow_acc
+
+    return result
+
+  def path_CVA(self, NPVs, curr_acc):
+
+    # Pathwise CVA integral, its mean over paths is the CVA
+    surv_prob = self.surv_curve.SurvProb(0, self.time_steps)
+    def_prob_time_step = surv_prob[0:-1]-surv_prob[1:]
+
+    mat = np.maximum(NPVs / curr_acc,0)
+    mat = (mat[:,0:-1]+mat[:,1:])/2
+
+    mat = mat*def_prob_time_step*(1-self.recovery)
+
+    return np.sum(mat, axis = 1)
+
+  def run(self, num_sims, pfe_quantile = 95, stream = None):
+
+    # A(t,T) and B(t,T) are shared by every path, compute them once per grid
+    self.HW.precompute(self.time_steps, self.portfolio.unique_dates)
+
+    NPVs, rates, curr_acc = self.simulate_batch(num_sims, stream)
+
+    return self.summarize(NPVs, rates, curr_acc, pfe_quantile)
+
+  def summarize(self, NPVs, rates, curr_acc, pfe_quantile = 95):
+
+    positive_NPVs = np.maximum(NPVs,0)
+
+    return {'NPV': NPVs,
+            'rates': rates,
+            'numeraire': curr_acc,
+            'EPE': np.mean(positive_NPVs, axis = 0),
+            'PFE': np.percentile(positive_NPVs, q = pfe_quantile, axis = 0),
+            'CVA': np.mean(self.path_CVA(NPVs, curr_acc))}
+
+  def run_parallel(self, num_sims, stream, num_workers = 2, pfe_quantile = 95, start_method = None):
+
+    # run split over worker processes by path ranges of the stream. Every path draws
+    # the same normals as in the serial run, so the result is bit-identical to
+    # run(num_sims, pfe_quantile, stream).
+    # start_method is the multiprocessing start method; None forks on Linux and uses
+    # the platform default elsewhere (spawn on Windows and macOS). The engine and the
+    # stream reach the workers through the pool initializer, so with spawn they are
+    # pickled once per worker. When the default start method cannot be used the run is
+    # serial, with a warning; an explicit start_method that cannot be used raises.
+
+    self.HW.precompute(self.time_steps, self.portfolio.unique_dates)
+
+    ranges = stream.path_ranges(num_sims, num_workers)
+
+    context = process_pools.pool_context(start_method, (self, stream))
+
+    if context is None:
+      return self.run(num_sims, pfe_quantile, stream)
+
+    with context.Pool(len(ranges), initializer = _init_engine_worker, initargs = (self, stream)) as pool:
+      batches = pool.map(_simulate_range, ranges)
+
+    NPVs, rates, curr_acc = [np.concatenate(parts) for parts in zip(*batches)]
+
+    return self.summarize(NPVs, rates, curr_acc, pfe_quantile)
+
+  def run_streaming(self, num_sims, batch_size = 10000, pfe_quantiles = (95,), accumulator = None, stream = None, start = 0):
+
+    # Same figures as run for any number of paths: batches of paths are simulated,
+    # folded into a risk_metrics.ExposureAccumulator and discarded. Accumulators from
+    # separate workers can be combined with accumulator.merge.
+
+    self.HW.precompute(self.time_steps, self.portfolio.unique_dates)
+
+    if accumulator is None:
+      accumulator = risk_metrics.ExposureAccumulator(len(self.time_steps), pfe_quantiles)
+
+    cva_sum = 0.0
+    done = 0
+
+    while done < num_sims:
+
+      batch = min(batch_size, num_sims - done)
+
+      NPVs, rates, curr_acc = self.simulate_batch(batch, stream, start + done)
+
+      accumulator.update(NPVs)
+      cva_sum += np.sum(self.path_CVA(NPVs, curr_acc))
+
+      done += batch
+
+    return {'accumulator': accumulator,
+            'EE': accumulator.EE(),
+            'EPE': accumulator.EPE(),
+            'PFE': accumulator.PFE(),
+            'CVA': cva_sum / num_sims}
+
+
+# Engine and stream seen by the forked workers of HWExposureEngine.run_parallel
+_engine_state = {}
+
+def _init_engine_worker(engine, stream):
+
+  _engine_state['engine'] = engine
+  _engine_state['stream'] = stream
+
+def _simulate_range(path_range):
+
+  engine, stream = _engine_state['engine'], _engine_state['stream']
+  start, num_sims = path_range
+
+  return engine.simulate_batch(num_sims, stream, start)
+
+
 class SurvCurve:
 
   def __init__(self, intensity):
@@ -0,0 +1,423 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+import torch
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+# Month abbreviations found in the DATA files ('09-may-24'), English and Spanish
+MONTHS = {'jan': 1, 'ene': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'abr': 4, 'may': 5, 'jun': 6,
+          'jul': 7, 'aug': 8, 'ago': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12, 'dic': 12}
+
+# Columns of CDS_Data.csv: quoted spreads (6M to 30Y), their maturities in years and
+# identifiers of a row
+CDS_SPREAD_COLUMNS = ['Spread6M', 'Spread1Y', 'Spread2Y', 'Spread3Y', 'Spread4Y', 'Spread5Y',
+                      'Spread7Y', 'Spread10Y', 'Spread15Y', 'Spread20Y', 'Spread30Y']
+CDS_SPREAD_MATURITIES = [0.5, 1, 2, 3, 4, 5, 7, 10, 15, 20, 30]
+CDS_ID_COLUMNS = ['Date', 'Ticker', 'ShortName', 'RedCode', 'Tier', 'Ccy', 'DocClause']
+
+# Files of DATA ingested by MarketDataStore.ingest_defaults: name -> (file, kind, read options)
+DEFAULT_SOURCES = {'equity': ('Histdata_equity.csv', 'timeseries', {'date_format': '%Y-%m-%d %H:%M:%S'}),
+                   'irs_history': ('IRS_History.csv', 'timeseries', {'date_format': '%d/%m/%Y'}),
+                   'cds': ('CDS_Data.csv', 'cds', {})}
+
+
+def parse_percent(column):
+
+    # '0.58%' -> 0.0058, empty -> nan. Vectorized string ops instead of a regex replace
+    return pd.to_numeric(column.astype(str).str.rstrip('%'), errors='coerce').to_numpy() / 100
+
+
+def parse_short_dates(column):
+
+    # 'dd-mmm-yy' strings to datetime64[D]
+    parts = column.astype(str).str.lower().str.split('-', expand = True)
+
+    years = 2000 + parts[2].astype(int)
+    months = parts[1].map(MONTHS)
+
+    return pd.to_datetime(pd.DataFrame({'year': years, 'month': months, 'day': parts[0].astype(int)})).to_numpy().astype('datetime64[D]')
+
+
+def to_day(date):
+
+    return None if date is None else np.datetime64(pd.Timestamp(date).date(), 'D')
+
+
+def encode(column):
+
+    # Dictionary encoding of a string column: int32 codes and the sorted dictionary
+    values = column.fillna('').astype(str).to_numpy()
+    dictionary, codes = np.unique(values, return_inverse = True)
+
+    return codes.astype(np.int32), dictionary.tolist()
+
+
+class TimeSeriesTable:
+
+    def __init__(self, path):
+
+        # Dates x columns matrix of a history (equity spots and vols, swap rates). Arrays
+        # are memory mapped copy-on-write, so opening costs nothing, slices only touch the
+        # pages they cover and tensors share memory with the map.
+
+        self.path = path
+
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+        self.columns = self.meta['columns']
+        self.column_index = {c: i for i, c in enumerate(self.columns)}
+
+        self.dates = np.load(os.path.join(path, 'dates.npy'), mmap_mode = 'c')
+        self.values = np.load(os.path.join(path, 'values.npy'), mmap_mode = 'c')
+
+    def __len__(self):
+        return len(self.dates)
+
+    def date_slice(self, start = None, end = None):
+
+        # Rows between start and end, both included as in DataFrame.loc
+        first = 0 if start is None else np.searchsorted(self.dates, to_day(start), side = 'left')
+        last = len(self.dates) if end is None else np.searchsorted(self.dates, to_day(end), side = 'right')
+
+        return slice(first, last)
+
+    def column_selector(self, columns = None):
+
+        if columns is None:
+            return slice(None)
+
+        if isinstance(columns, str):
+            columns = [columns]
+
+        index = [self.column_index[c] for c in columns]
+
+        # Consecutive columns are taken as a slice so the result stays a view
+        if index == list(range(index[0], index[0] + len(index))):
+            return slice(index[0], index[0] + len(index))
+
+        return np.array(index)
+
+    def slice(self, start = None, end = None, columns = None):
+
+        rows = self.date_slice(start, end)
+
+        return self.dates[rows], self.values[rows][:, self.column_selector(columns)]
+
+    def tensor(self, start = None, end = None, columns = None):
+
+        _, values = self.slice(start, end, columns)
+
+        return torch.from_numpy(values)
+
+    def to_frame(self, start = None, end = None, columns = None):
+
+        rows = self.date_slice(start, end)
+        selector = self.column_selector(columns)
+
+        return pd.DataFrame(self.values[rows][:, selector],
+                            index = pd.DatetimeIndex(self.dates[rows], name = self.meta['index_name']),
+                            columns = np.array(self.columns)[selector])
+
+
+class CDSTable:
+
+    def __init__(self, path):
+
+        # CDS quotes in columnar form. Rows are sorted by ticker and date and ticker_start
+        # holds the first row of every ticker, so the quotes of a ticker are a contiguous
+        # range of each field. String fields are dictionary encoded.
+
+        self.path = path
+
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+        self.dictionaries = self.meta['dictionaries']
+        self.tickers = self.dictionaries['Ticker']
+        self.ticker_index = {t: i for i, t in enumerate(self.tickers)}
+        self.spread_columns = self.meta['spread_columns']
+
+        self.fields = {field: np.load(os.path.join(path, file), mmap_mode = 'c') for field, file in self.meta['fields'].items()}
+
+        self.ticker_start = self.fields['ticker_start']
+
+    def __len__(self):
+        return len(self.fields['Date'])
+
+    def rows(self, tickers = None, start = None, end = None):
+
+        # Row indices (a slice for a single ticker or the whole table) of the quotes of
+        # tickers between start and end
+        if tickers is None:
+            ranges = [(0, len(self))]
+        else:
+            if isinstance(tickers, str):
+                tickers = [tickers]
+            codes = [self.ticker_index[t] for t in tickers]
+            ranges = [(self.ticker_start[c], self.ticker_start[c+1]) for c in codes]
+
+        if start is None and end is None and len(ranges) == 1:
+            return slice(int(ranges[0][0]), int(ranges[0][1]))
+
+        rows = np.concatenate([np.arange(a, b) for a, b in ranges])
+
+        dates = self.fields['Date'][rows]
+        keep = np.ones(len(rows), dtype = bool)
+
+        if start is not None:
+            keep &= dates >= to_day(start)
+        if end is not None:
+            keep &= dates <= to_day(end)
+
+        return rows[keep]
+
+    def field(self, name, tickers = None, start = None, end = None):
+
+        return self.fields[name][self.rows(tickers, start, end)]
+
+    def spreads(self, tickers = None, start = None, end = None):
+
+        # (rows, tenors) spreads as decimals, nan where not quoted
+        return self.field('spreads', tickers, start, end)
+
+    def tensor(self, name = 'spreads', tickers = None, start = None, end = None):
+
+        return torch.from_numpy(self.field(name, tickers, start, end))
+
+    def to_frame(self, tickers = None, start = None, end = None):
+
+        # Decoded view with the same column names as the CSV
+        rows = self.rows(tickers, start, end)
+
+        data = {'Date': pd.DatetimeIndex(self.fields['Date'][rows])}
+
+        for name, dictionary in self.dictionaries.items():
+            data[name] = np.array(dictionary, dtype = object)[self.fields[name][rows]]
+
+        frame = pd.DataFrame(data)
+        frame[self.spread_columns] = self.fields['spreads'][rows]
+        frame['Recovery'] = self.fields['Recovery'][rows]
+
+        return frame
+
+
+class MarketDataStore:
+
+    def __init__(self, root):
+
+        # Directory of ingested datasets, one subdirectory per dataset. CSVs are parsed
+        # once by the ingest methods; afterwards tables open as memory maps.
+
+        self.root = root
+        self.tables = {}
+
+        os.makedirs(root, exist_ok = True)
+
+        self.recover()
+
+    def lock(self, name):
+
+        # Exclusive lock of a dataset, held by its writer for the whole write: an OS lock on
+        # <name>.lock, released by the system if the writer dies. None when another writer
+        # (in this or another process) holds it.
+        f = open(os.path.join(self.root, name + '.lock'), 'a+')
+
+        try:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.close()
+            return None
+
+        return f
+
+    def unlock(self, lock):
+
+        # Closing the file releases the lock. The lock file itself stays, so a writer never
+        # locks a file another one is about to delete
+        lock.close()
+
+    def recover(self):
+
+        # Finishes writes interrupted by a crash (see write): a dataset caught between its
+        # two renames is restored from its .old copy, other leftovers are removed. Datasets
+        # whose lock is held belong to a live writer and are left alone.
+        for d in os.listdir(self.root):
+
+            if not d.endswith(('.old', '.tmp')):
+                continue
+
+            path = os.path.join(self.root, d)
+            final = path[:-len('.old')]
+
+            lock = self.lock(os.path.basename(final))
+
+            if lock is None:
+                continue
+
+            try:
+                if d.endswith('.old'):
+                    if os.path.exists(final):
+                        shutil.rmtree(path, ignore_errors = True)
+                    else:
+                        os.rename(path, final)
+                else:
+                    shutil.rmtree(path, ignore_errors = True)
+            finally:
+                self.unlock(lock)
+
+    def names(self):
+
+        return sorted(d for d in os.listdir(self.root)
+                      if not d.endswith(('.tmp', '.old')) and os.path.isfile(os.path.join(self.root, d, 'meta.json')))
+
+    def __contains__(self, name):
+        return name in self.names()
+
+    def __getitem__(self, name):
+
+        if name not in self.tables:
+
+            path = os.path.join(self.root, name)
+
+            # While a writer swaps the dataset the previous version sits in <name>.old
+            # between the two renames, and is read from there. The last attempt covers a
+            # swap that completes while the first two are tried.
+            for candidate in (path, path + '.old', path):
+                try:
+                    with open(os.path.join(candidate, 'meta.json')) as f:
+                        kind = json.load(f)['kind']
+
+                    self.tables[name] = TimeSeriesTable(candidate) if kind == 'timeseries' else CDSTable(candidate)
+                    break
+                except FileNotFoundError:
+                    continue
+            else:
+                raise KeyError(name)
+
+        return self.tables[name]
+
+    def is_stale(self, name, csv_path):
+
+        # True when the dataset is missing or was built from a different version of the CSV
+        if name not in self:
+            return True
+
+        with open(os.path.join(self.root, name, 'meta.json')) as f:
+            meta = json.load(f)
+
+        stat = os.stat(csv_path)
+
+        return meta['source_size'] != stat.st_size or meta['source_mtime'] != stat.st_mtime
+
+    def write(self, name, csv_path, meta, arrays):
+
+        # Written to a temporary directory and swapped in by renames, so readers never see
+        # half a dataset: the previous version is moved aside to .old, the new one renamed
+        # into place and only then is the old one deleted. A crash between the two renames
+        # leaves the previous version in .old, which recover restores. The dataset lock is
+        # held throughout, so concurrent writers and recover keep off each other's files.
+        lock = self.lock(name)
+
+        if lock is None:
+            raise RuntimeError('Dataset ' + name + ' is being written by another writer')
+
+        try:
+            final = os.path.join(self.root, name)
+            tmp = final + '.tmp'
+            old = final + '.old'
+
+            shutil.rmtree(tmp, ignore_errors = True)
+            os.makedirs(tmp)
+
+            for file, array in arrays.items():
+                np.save(os.path.join(tmp, file), np.ascontiguousarray(array))
+
+            stat = os.stat(csv_path)
+            meta.update({'source': os.path.abspath(csv_path), 'source_size': stat.st_size, 'source_mtime': stat.st_mtime})
+
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+
+            self.tables.pop(name, None)
+
+            shutil.rmtree(old, ignore_errors = True)
+            if os.path.exists(final):
+                os.rename(final, old)
+
+            os.rename(tmp, final)
+            shutil.rmtree(old, ignore_errors = True)
+
+        finally:
+            self.unlock(lock)
+
+        return self[name]
+
+    def ingest_timeseries(self, name, csv_path, date_format = None, **read_options):
+
+        data = pd.read_csv(csv_path, index_col = 0, encoding = 'utf-8-sig', **read_options)
+        data.index = pd.to_datetime(data.index, format = date_format)
+        data = data.sort_index()
+
+        meta = {'kind': 'timeseries', 'columns': [str(c) for c in data.columns], 'index_name': data.index.name}
+
+        arrays = {'dates.npy': data.index.to_numpy().astype('datetime64[D]'),
+                  'values.npy': data.to_numpy(dtype = np.float64)}
+
+        return self.write(name, csv_path, meta, arrays)
+
+    def ingest_cds(self, name, csv_path):
+
+        data = pd.read_csv(csv_path, sep = ';', dtype = str, keep_default_na = False)
+
+        dates = parse_short_dates(data['Date'])
+
+        fields = {}
+        dictionaries = {}
+
+        for column in CDS_ID_COLUMNS[1:]:
+            fields[column], dictionaries[column] = encode(data[column])
+
+        order = np.lexsort((dates, fields['Ticker']))
+
+        fields = {column: codes[order] for column, codes in fields.items()}
+        fields['Date'] = dates[order]
+
+        spreads = np.column_stack([parse_percent(data[c]) for c in CDS_SPREAD_COLUMNS])
+        fields['spreads'] = spreads[order]
+        fields['Recovery'] = parse_percent(data['Recovery'])[order]
+
+        counts = np.bincount(fields['Ticker'], minlength = len(dictionaries['Ticker']))
+        fields['ticker_start'] = np.concatenate(([0], np.cumsum(counts)))
+
+        meta = {'kind': 'cds', 'spread_columns': CDS_SPREAD_COLUMNS, 'dictionaries': dictionaries,
+                'fields': {field: field + '.npy' for field in fields}}
+
+        return self.write(name, csv_path, meta, {field + '.npy': array for field, array in fields.items()})
+
+    def ingest_defaults(self, data_dir, force = False):
+
+        # Ingests the histories of DATA that are missing or out of date
+        for name, (file, kind, options) in DEFAULT_SOURCES.items():
+
+            csv_path = os.path.join(data_dir, file)
+
+            if force or self.is_stale(name, csv_path):
+                if kind == 'timeseries':
+                    self.ingest_timeseries(name, csv_path, **options)
+                else:
+                    self.ingest_cds(name, csv_path)
+
+        return self
@@ -1,21 +1,78 @@
+import contextlib
 import numpy as np
 import torch
+from multiprocessing import shared_memory, resource_tracker
+import risk_metrics
+import process_pools
 
 class Portfolio_Delta_NPV_Calculator:
 
-    def __init__(self, notionals ,contracts, option = 'numpy'):
+    def __init__(self, notionals ,contracts, option = 'numpy', num_workers = 1, parallel_shard = 'contracts',
+                 start_method = None):
         self.contracts = contracts
         self.notionals = notionals
         self.option = option
+        # num_workers > 1 evaluates the contracts on a process pool, sharded either by
+        # 'contracts' or by 'scenarios' (row chunks of the risk factor matrix).
+        # start_method is the multiprocessing start method of the pool. None forks on
+        # Linux and uses the platform default elsewhere (spawn on Windows and macOS);
+        # see process_pools.pool_context for what happens when it cannot be used.
+        self.num_workers = num_workers
+        self.parallel_shard = parallel_shard
+        self.start_method = start_method
+        self.pool = None
+        self.serial_run = False
+
+    @contextlib.contextmanager
+    def worker_pool(self):
+
+        # One pool for the whole run: value() calls made inside the block (every chunk of
+        # compute_scenarios_pl_chunked, say) share it instead of starting their own.
+        if self.num_workers <= 1 or self.pool is not None or self.serial_run:
+            yield self.pool
+            return
+
+        context = process_pools.pool_context(self.start_method, (self.contracts, self.option))
+
+        if context is None:
+            # Decided (and warned about) once for the whole run
+            self.serial_run = True
+            try:
+                yield None
+            finally:
+                self.serial_run = False
+            return
+
+        # Workers attach to the shared memory blocks; they must report to the parent's
+        # resource tracker rather than start their own, which would unlink the blocks
+        # when the worker exits
+        resource_tracker.ensure_running()
+
+        self.pool = context.Pool(self.num_workers, initializer = _init_worker, initargs = (self.contracts, self.option))
+
+        try:
+            yield self.pool
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
 
     def value(self,t ,risk_factors):
 
+        if self.num_workers > 1:
+            with self.worker_pool() as pool:
+                if pool is not None:
+                    return self.value_parallel(t, risk_factors, pool)
+
         if self.option == 'numpy':
             portfolio_value = np.zeros(risk_factors.shape[0])
             component_values = np.zeros((risk_factors.shape[0],len(self.contracts)))
         elif self.option == 'torch':
-            portfolio_value = torch.zeros(risk_factors.shape[0])
-            component_values = torch.zeros((risk_factors.shape[0],len(self.contracts)))
+            # Double precision, as the shared memory blocks of value_parallel, so the
+            # serial and the parallel paths return the same values and dtype
+            risk_factors = torch.as_tensor(risk_factors).to(torch.float64)
+            portfolio_value = torch.zeros(risk_factors.shape[0], dtype = torch.float64)
+            component_values = torch.zeros((risk_factors.shape[0],len(self.contracts)), dtype = torch.float64)
 
         for i, (n, c) in enumerate(zip(self.notionals,self.contracts)):
             
@@ -28,11 +85,507 @@ class Portfolio_Delta_NPV_Calculator:
 
         return portfolio_value, component_values
     
+    def value_parallel(self, t, risk_factors, pool):
+
+        # The risk factor matrix and the component value matrix live in shared memory:
+        # workers attach to them by name and write their own columns (or rows), so
+        # nothing but the task bounds and the block names is pickled and the result
+        # does not depend on scheduling. The contracts reach the workers once, through
+        # the pool initializer.
+
+        risk_factors_np = _to_numpy(risk_factors).astype(float)
+
+        num_scenarios, num_contracts = risk_factors_np.shape[0], len(self.contracts)
+
+        rf_shm = shared_memory.SharedMemory(create = True, size = max(risk_factors_np.nbytes, 1))
+        out_shm = shared_memory.SharedMemory(create = True, size = max(num_scenarios * num_contracts * 8, 1))
+
+        try:
+            np.ndarray(risk_factors_np.shape, dtype = float, buffer = rf_shm.buf)[:] = risk_factors_np
+
+            if self.parallel_shard == 'contracts':
+                bounds = np.linspace(0, num_contracts, min(self.num_workers, num_contracts) + 1).astype(int)
+            elif self.parallel_shard == 'scenarios':
+                bounds = np.linspace(0, num_scenarios, min(self.num_workers, num_scenarios) + 1).astype(int)
+            else:
+                raise ValueError('parallel_shard must be either contracts or scenarios')
+
+            blocks = (t, rf_shm.name, risk_factors_np.shape, out_shm.name, (num_scenarios, num_contracts))
+
+            tasks = [(self.parallel_shard, start, end) + blocks for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+            pool.map(_evaluate_task, tasks)
+
+            component_values = np.ndarray((num_scenarios, num_contracts), dtype = float, buffer = out_shm.buf).copy()
+
+        finally:
+            rf_shm.close()
+            rf_shm.unlink()
+            out_shm.close()
+            out_shm.unlink()
+
+        if self.option == 'numpy':
+            portfolio_value = np.sum(self.notionals*component_values, axis = 1)
+        elif self.option == 'torch':
+            component_values = torch.from_numpy(component_values)
+            portfolio_value = torch.sum(self.notionals*component_values, dim = 1)
+
+        return portfolio_value, component_values
+
     def compute_scenarios_pl(self, risk_factors_base_scenario, delta_t, risk_factors_shocked):
-        
-        portfolio_value_base_scenario, component_values_base_scenario = self.value(0,risk_factors_base_scenario)
 
-        portfolio_value_shocked, component_values_shocked  = self.value(delta_t,risk_factors_shocked)
+        with self.worker_pool():
+
+            portfolio_value_base_scenario, component_values_base_scenario = self.value(0,risk_factors_base_scenario)
+
+            portfolio_value_shocked, component_values_shocked  = self.value(delta_t,risk_factors_shocked)
 
         return portfolio_value_shocked - portfolio_value_base_scenario, component_values_shocked - component_values_base_scenario
 
+    def compute_scenarios_pl_chunked(self, risk_factors_base_scenario, delta_t, risk_factors_shocked, chunk_size = 10000):
+
+        # Generator version of compute_scenarios_pl. risk_factors_shocked is either a
+        # (num_scenarios, num_risk_factors) array, sliced in chunks of chunk_size rows,
+        # or any iterable that already yields chunks of scenarios.
+
+        with self.worker_pool():
+
+            portfolio_value_base_scenario, component_values_base_scenario = self.value(0,risk_factors_base_scenario)
+
+            if hasattr(risk_factors_shocked, 'shape'):
+                chunks = (risk_factors_shocked[i:i+chunk_size] for i in range(0, risk_factors_shocked.shape[0], chunk_size))
+            else:
+                chunks = risk_factors_shocked
+
+            for chunk in chunks:
+
+                portfolio_value_shocked, component_values_shocked = self.value(delta_t,chunk)
+
+                yield portfolio_value_shocked - portfolio_value_base_scenario, component_values_shocked - component_values_base_scenario
+
+    def compute_var_es(self, risk_factors_base_scenario, delta_t, risk_factors_shocked, alpha = 0.99,
+                       chunk_size = 10000, num_scenarios = None, components = True, incremental = False):
+
+        # Streaming VaR / ES (losses reported as positive numbers). Only the portfolio
+        # P&L vector and the k = ceil((1-alpha) * num_scenarios) worst scenarios are
+        # kept, so memory does not grow with num_scenarios x num_contracts. k comes from
+        # risk_metrics.tail_size, which guards the ceil against round off (a plain ceil
+        # gives 201 scenarios for alpha = 0.99 and 20000 scenarios).
+        # components: keep the component P&L of the tail scenarios -> component ES.
+        # incremental: keep, per contract, the tail of the P&L without that contract
+        # -> incremental ES = ES(portfolio) - ES(portfolio without the contract).
+
+        if num_scenarios is None:
+            num_scenarios = risk_factors_shocked.shape[0]
+
+        k = risk_metrics.tail_size(alpha, num_scenarios)
+
+        notionals = _to_numpy(self.notionals)
+
+        portfolio_pl = np.zeros(num_scenarios)
+
+        tail_pl = np.zeros(0)
+        tail_index = np.zeros(0, dtype = int)
+        tail_components = np.zeros((0, len(self.contracts)))
+        tail_without = np.zeros((0, len(self.contracts)))
+
+        start = 0
+
+        for chunk_pl, chunk_components in self.compute_scenarios_pl_chunked(risk_factors_base_scenario, delta_t,
+                                                                            risk_factors_shocked, chunk_size):
+
+            chunk_pl = _to_numpy(chunk_pl)
+            end = start + len(chunk_pl)
+
+            portfolio_pl[start:end] = chunk_pl
+
+            # Merge the chunk into the tail buffer and keep the k worst scenarios
+            tail_pl = np.concatenate((tail_pl, chunk_pl))
+            tail_index = np.concatenate((tail_index, np.arange(start, end)))
+
+            if components or incremental:
+                chunk_components = notionals * _to_numpy(chunk_components)
+
+            if components:
+                tail_components = np.concatenate((tail_components, chunk_components))
+
+            if incremental:
+                tail_without = np.concatenate((tail_without, chunk_pl[:,None] - chunk_components))
+                tail_without = np.partition(tail_without, min(k, len(tail_without)) - 1, axis = 0)[:k]
+
+            if len(tail_pl) > k:
+                keep = np.argpartition(tail_pl, k - 1)[:k]
+                tail_pl = tail_pl[keep]
+                tail_index = tail_index[keep]
+                if components:
+                    tail_components = tail_components[keep]
+
+            start = end
+
+        order = np.argsort(tail_pl)
+
+        results = {'portfolio_pl': portfolio_pl,
+                   'VaR': -tail_pl[order[-1]],
+                   'ES': -np.mean(tail_pl),
+                   'tail_scenarios': tail_index[order]}
+
+        if components:
+            results['component_ES'] = -np.mean(tail_components, axis = 0)
+            results['tail_components'] = tail_components[order]
+
+        if incremental:
+            results['incremental_ES'] = results['ES'] + np.mean(tail_without, axis = 0)
+
+        return results
+
+    def compute_pl_metrics(self, risk_factors_base_scenario, delta_t, risk_factors_shocked, chunk_size = 10000,
+                           accumulator = None, tail_capacity = 10000):
+
+        # Folds the streamed portfolio P&L into a risk_metrics.PnLAccumulator, which gives
+        # VaR / ES and can be merged with the accumulators of other workers.
+
+        if accumulator is None:
+            accumulator = risk_metrics.PnLAccumulator(tail_capacity)
+
+        for chunk_pl, _ in self.compute_scenarios_pl_chunked(risk_factors_base_scenario, delta_t, risk_factors_shocked, chunk_size):
+            accumulator.update(_to_numpy(chunk_pl))
+
+        return accumulator
+
+    def compute_sensitivities(self, risk_factors_base_scenario, delta_t):
+
+        # First and second order sensitivities of every contract to the risk factors,
+        # taken at the base scenario rolled to delta_t, with one vectorized
+        # forward-over-reverse autograd pass. Needs option = 'torch'. The results are per
+        # unit notional, so changing notionals keeps them valid; they are recomputed when
+        # the base scenario, delta_t or the contracts themselves change.
+
+        if self.option != 'torch':
+            raise ValueError('Delta-gamma sensitivities need the torch contracts (option = torch)')
+
+        base = torch.as_tensor(risk_factors_base_scenario).reshape(-1).detach()
+
+        def contract_values(x):
+            return torch.cat([c(delta_t, x.reshape(1,-1)).reshape(1) for c in self.contracts])
+
+        def values_and_aux(y):
+            values = contract_values(y)
+            return values, values.detach()
+
+        def first_order(x):
+            grad, values = torch.func.jacrev(values_and_aux, has_aux = True)(x)
+            return grad, (grad, values)
+
+        gammas, (deltas, values) = torch.func.jacfwd(first_order, has_aux = True)(base)
+
+        _, values_today = self.value(0, base.reshape(1,-1))
+
+        self.sensitivities = {'base_scenario': base.numpy().copy(),
+                              'delta_t': delta_t,
+                              'contracts': list(self.contracts),
+                              'theta': _to_numpy(values).astype(float) - _to_numpy(values_today).reshape(-1),
+                              'delta': _to_numpy(deltas).astype(float),
+                              'gamma': _to_numpy(gammas).astype(float)}
+
+        return self.sensitivities
+
+    def sensitivities_valid(self, sens, base, delta_t):
+
+        # The cache holds the contract objects it was computed for, so adding, removing,
+        # reordering or replacing contracts is noticed (holding them also stops their ids
+        # from being reused)
+        return sens is not None and sens['delta_t'] == delta_t and np.array_equal(sens['base_scenario'], base) \
+            and len(sens['contracts']) == len(self.contracts) \
+            and all(a is b for a, b in zip(sens['contracts'], self.contracts))
+
+    def compute_scenarios_pl_delta_gamma(self, risk_factors_base_scenario, delta_t, risk_factors_shocked, components = False):
+
+        # Quadratic approximation of compute_scenarios_pl:
+        # pl_i = theta_i + delta_i . dx + 1/2 dx' gamma_i dx, dx = shocked - base.
+        # Portfolio sensitivities are aggregated first, so the cost per scenario does
+        # not depend on the number of contracts unless components are requested.
+
+        sens = getattr(self, 'sensitivities', None)
+        base = _to_numpy(risk_factors_base_scenario).reshape(-1)
+
+        if not self.sensitivities_valid(sens, base, delta_t):
+            sens = self.compute_sensitivities(risk_factors_base_scenario, delta_t)
+
+        notionals = _to_numpy(self.notionals).astype(float)
+
+        d_x = _to_numpy(risk_factors_shocked) - base
+
+        portfolio_delta = notionals @ sens['delta']
+        portfolio_gamma = np.tensordot(notionals, sens['gamma'], axes = 1)
+
+        portfolio_pl = notionals @ sens['theta'] + d_x @ portfolio_delta + 0.5*np.sum((d_x @ portfolio_gamma)*d_x, axis = 1)
+
+        if not components:
+            return portfolio_pl
+
+        component_pl = sens['theta'] + d_x @ sens['delta'].T + 0.5*np.einsum('sj,cjk,sk->sc', d_x, sens['gamma'], d_x)
+
+        return portfolio_pl, component_pl
+
+    def delta_gamma_report(self, risk_factors_base_scenario, delta_t, risk_factors_shocked, sample_size = 1000,
+                           tolerance = 0.05, seed = None):
+
+        # Compares delta-gamma against full revaluation on a random sample of the
+        # scenarios. A contract is flagged when its RMSE exceeds tolerance times the
+        # standard deviation of its full revaluation P&L.
+
+        num_scenarios = risk_factors_shocked.shape[0]
+        sample = np.sort(np.random.default_rng(seed).choice(num_scenarios, min(sample_size, num_scenarios), replace = False))
+
+        shocked_sample = risk_factors_shocked[sample]
+
+        full_pl, full_components = self.compute_scenarios_pl(risk_factors_base_scenario, delta_t, shocked_sample)
+        approx_pl, approx_components = self.compute_scenarios_pl_delta_gamma(risk_factors_base_scenario, delta_t,
+                                                                             shocked_sample, components = True)
+
+        full_pl = _to_numpy(full_pl)
+        full_components = _to_numpy(full_components)
+
+        error = approx_components - full_components
+
+        rmse = np.sqrt(np.mean(error**2, axis = 0))
+        scale = np.std(full_components, axis = 0)
+        relative_rmse = rmse / np.where(scale > 0, scale, 1.0)
+
+        return {'sample': sample,
+                'full_pl': full_pl,
+                'approx_pl': approx_pl,
+                'portfolio_rmse': np.sqrt(np.mean((approx_pl - full_pl)**2)),
+                'component_rmse': rmse,
+                'component_max_error': np.max(np.abs(error), axis = 0),
+                'component_relative_rmse': relative_rmse,
+                'flagged_contracts': np.flatnonzero(relative_rmse > tolerance)}
+
+
+class Incremental_Risk_Calculator:
+
+    def __init__(self, calculator, risk_factors_base_scenario, delta_t, risk_factors_shocked, alpha = 0.99,
+                 weights = None, dtype = np.float64):
+
+        # Keeps the scenario P&L of every contract of calculator (per unit notional, one row
+        # per contract) so that adding, resizing or removing a trade only revalues that
+        # trade and updates the portfolio P&L by addition. weights are optional scenario
+        # probabilities (e.g. age weights from HistoricalScenarioGenerator.weights) and
+        # dtype = np.float32 halves the memory of the cache.
+
+        self.option = calculator.option
+        self.base = risk_factors_base_scenario
+        self.delta_t = delta_t
+        self.shocked = risk_factors_shocked
+        self.alpha = alpha
+        self.weights = weights
+        self.dtype = dtype
+
+        _, component_pl = calculator.compute_scenarios_pl(risk_factors_base_scenario, delta_t, risk_factors_shocked)
+
+        unit_pl = np.asarray(_to_numpy(component_pl), dtype = dtype).T
+        num_contracts, self.num_scenarios = unit_pl.shape
+
+        # Rows beyond num_contracts are spare capacity, so additions do not copy the cache
+        self.unit_pl = np.zeros((max(2*num_contracts, 16), self.num_scenarios), dtype = dtype)
+        self.unit_pl[:num_contracts] = unit_pl
+
+        self.contracts = list(calculator.contracts)
+        self.notionals = np.array(_to_numpy(calculator.notionals), dtype = float).reshape(-1)
+        self.keys = list(range(num_contracts))
+        self.rows = {key: i for i, key in enumerate(self.keys)}
+        self.next_key = num_contracts
+
+        self.refresh()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def refresh(self):
+
+        # Recomputes the portfolio P&L from the cache, clearing the rounding drift of many updates
+        self.portfolio_pl = self.notionals @ self.unit_pl[:len(self)].astype(float)
+
+    def contract_pl(self, contract):
+
+        # Scenario P&L of one contract per unit notional
+        single = Portfolio_Delta_NPV_Calculator(np.ones(1), [contract], self.option)
+
+        if self.option == 'torch':
+            single.notionals = torch.ones(1, dtype = torch.float64)
+
+        _, component_pl = single.compute_scenarios_pl(self.base, self.delta_t, self.shocked)
+
+        return np.asarray(_to_numpy(component_pl), dtype = float).reshape(-1)
+
+    def add_contract(self, contract, notional, key = None):
+
+        if key is None:
+            key = self.next_key
+            self.next_key += 1
+
+        if key in self.rows:
+            raise ValueError('Contract ' + str(key) + ' already in the portfolio')
+
+        pl = self.contract_pl(contract)
+
+        row = len(self)
+
+        if row == self.unit_pl.shape[0]:
+            self.unit_pl = np.concatenate((self.unit_pl, np.zeros_like(self.unit_pl)))
+
+        self.unit_pl[row] = pl
+        self.contracts.append(contract)
+        self.notionals = np.append(self.notionals, notional)
+        self.keys.append(key)
+        self.rows[key] = row
+
+        self.portfolio_pl += notional*pl
+
+        return key
+
+    def modify_contract(self, key, notional = None, contract = None):
+
+        # A notional change is a pure update of the portfolio P&L, a new contract
+        # definition revalues that contract only
+        row = self.rows[key]
+
+        old_pl = self.notionals[row]*self.unit_pl[row].astype(float)
+
+        if contract is not None:
+            self.unit_pl[row] = self.contract_pl(contract)
+            self.contracts[row] = contract
+
+        if notional is not None:
+            self.notionals[row] = notional
+
+        self.portfolio_pl += self.notionals[row]*self.unit_pl[row].astype(float) - old_pl
+
+    def remove_contract(self, key):
+
+        # The last row is moved into the freed one, so removal costs one row copy
+        row = self.rows.pop(key)
+        last = len(self) - 1
+
+        self.portfolio_pl -= self.notionals[row]*self.unit_pl[row].astype(float)
+
+        if row != last:
+            self.unit_pl[row] = self.unit_pl[last]
+            self.contracts[row] = self.contracts[last]
+            self.notionals[row] = self.notionals[last]
+            self.keys[row] = self.keys[last]
+            self.rows[self.keys[row]] = row
+
+        self.contracts.pop()
+        self.notionals = self.notionals[:last]
+        self.keys.pop()
+
+    def tail(self, portfolio_pl, alpha):
+
+        # Scenarios sorted from the worst and position of the VaR scenario
+        return risk_metrics.weighted_tail(portfolio_pl, self.weights, alpha)
+
+    def var_es(self, alpha = None, portfolio_pl = None):
+
+        alpha = self.alpha if alpha is None else alpha
+        portfolio_pl = self.portfolio_pl if portfolio_pl is None else portfolio_pl
+
+        return risk_metrics.weighted_var_es(portfolio_pl, self.weights, alpha)
+
+    def marginal_risk(self, unit_pl = None, alpha = None, portfolio_pl = None, window = 2):
+
+        # Marginal VaR / ES (derivatives with respect to the notionals) of the contracts
+        # whose unit P&L are the rows of unit_pl (the cached contracts by default).
+        # Marginal ES is the weighted mean unit loss over the tail scenarios; marginal VaR
+        # the mean unit loss over the scenarios within window ranks of the VaR scenario,
+        # a simple kernel estimate of E[loss | portfolio loss = VaR].
+
+        alpha = self.alpha if alpha is None else alpha
+        portfolio_pl = self.portfolio_pl if portfolio_pl is None else portfolio_pl
+        unit_pl = self.unit_pl[:len(self)] if unit_pl is None else np.atleast_2d(unit_pl)
+
+        order, last, weights = self.tail(portfolio_pl, alpha)
+
+        tail = order[:last+1]
+        around_var = order[max(last - window, 0):last + window + 1]
+
+        marginal_es = -(unit_pl[:, tail] @ weights[tail]) / np.sum(weights[tail])
+        marginal_var = -np.mean(unit_pl[:, around_var], axis = 1)
+
+        return marginal_var, marginal_es
+
+    def what_if(self, contract, notional, alpha = None):
+
+        # Pre-deal check: risk of the portfolio with the new trade, without adding it
+        alpha = self.alpha if alpha is None else alpha
+
+        pl = self.contract_pl(contract)
+        new_portfolio_pl = self.portfolio_pl + notional*pl
+
+        var_before, es_before = self.var_es(alpha)
+        var_after, es_after = self.var_es(alpha, new_portfolio_pl)
+
+        marginal_var, marginal_es = self.marginal_risk(pl, alpha, new_portfolio_pl)
+
+        return {'VaR_before': var_before,
+                'ES_before': es_before,
+                'VaR_after': var_after,
+                'ES_after': es_after,
+                'incremental_VaR': var_after - var_before,
+                'incremental_ES': es_after - es_before,
+                'marginal_VaR': marginal_var[0],
+                'marginal_ES': marginal_es[0],
+                'trade_pl': notional*pl}
+
+
+_worker_state = {}
+
+
+def _init_worker(contracts, option):
+
+    # One torch thread per worker: the pool already uses the cores, and a forked child
+    # must not rely on the intra-op thread pool it inherited from the parent
+    torch.set_num_threads(1)
+
+    _worker_state['contracts'] = contracts
+    _worker_state['option'] = option
+
+
+def _evaluate_task(task):
+
+    shard, start, end, t, rf_name, rf_shape, out_name, out_shape = task
+
+    contracts = _worker_state['contracts']
+
+    rf_shm = shared_memory.SharedMemory(name = rf_name)
+    out_shm = shared_memory.SharedMemory(name = out_name)
+
+    risk_factors = np.ndarray(rf_shape, dtype = float, buffer = rf_shm.buf)
+    out = np.ndarray(out_shape, dtype = float, buffer = out_shm.buf)
+
+    if shard == 'contracts':
+        rows, columns = slice(None), range(start, end)
+    else:
+        rows, columns = slice(start, end), range(len(contracts))
+
+    rf = risk_factors[rows]
+
+    if _worker_state['option'] == 'torch':
+        rf = torch.from_numpy(rf)
+
+    for i in columns:
+        out[rows, i] = _to_numpy(contracts[i](t, rf))
+
+    # The views must go before the blocks can be closed
+    del risk_factors, out, rf
+
+    rf_shm.close()
+    out_shm.close()
+
+
+def _to_numpy(x):
+
+    if torch.is_tensor(x):
+        return x.detach().numpy()
+
+    return np.asarray(x)
@@ -0,0 +1,48 @@
+import sys
+import pickle
+import warnings
+import multiprocessing
+
+
+def default_start_method():
+
+    # fork on Linux (workers inherit the parent's objects without pickling), the
+    # platform default elsewhere (spawn on Windows and macOS)
+    if sys.platform.startswith('linux'):
+        return 'fork'
+
+    return multiprocessing.get_start_method()
+
+
+def pool_context(start_method = None, payload = None):
+
+    # Multiprocessing context for a worker pool whose initializer receives payload, or
+    # None when the work has to run serially. Only fork hands the payload over without
+    # pickling it; with spawn or forkserver it must pickle.
+    # An explicit start_method that cannot be used raises ValueError. With the default
+    # start method the caller falls back to a serial run, with a RuntimeWarning.
+
+    method = default_start_method() if start_method is None else start_method
+
+    if method not in multiprocessing.get_all_start_methods():
+        problem = 'start method ' + method + ' is not available on ' + sys.platform
+        return _unusable(start_method, problem)
+
+    if method != 'fork':
+        try:
+            pickle.dumps(payload)
+        except Exception as error:
+            problem = 'the workers need pickled objects with start method ' + method + ' (' + repr(error) + ')'
+            return _unusable(start_method, problem)
+
+    return multiprocessing.get_context(method)
+
+
+def _unusable(start_method, problem):
+
+    if start_method is not None:
+        raise ValueError('Cannot start the worker pool: ' + problem)
+
+    warnings.warn('Running serially: ' + problem, RuntimeWarning, stacklevel = 3)
+
+    return None
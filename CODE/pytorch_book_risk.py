@@ -0,0 +1,272 @@
+import torch
+import numpy as np
+from pytorch_ir_curve import IR_Curve, IR_Swap, IR_Swap_Book
+from pytorch_credit_curve import Credit_Curve, CDS
+
+
+def pad_rows(rows, fill_values):
+
+    # Stacks 1-D tensors of different lengths into a (num_rows, max_length) tensor, each
+    # row padded with its own fill value
+    padded = torch.empty((len(rows), max(len(r) for r in rows)), dtype=torch.float64)
+
+    for k, row in enumerate(rows):
+        padded[k, :len(row)] = row
+        padded[k, len(row):] = fill_values[k]
+
+    return padded
+
+
+class SwapBook:
+
+    def __init__(self, swaps, fixed_rates, notionals = None):
+
+        # Receiver IR_Swaps priced with an IR_Swap_Book: times are the discount factor dates
+        # of the book (the union of the start, end and pay times of the trades).
+
+        self.swaps = swaps
+        self.book = IR_Swap_Book(swaps)
+        self.fixed_rates = torch.as_tensor(np.asarray(fixed_rates, dtype=float))
+        self.notionals = torch.ones(len(swaps), dtype=torch.float64) if notionals is None \
+                         else torch.as_tensor(np.asarray(notionals, dtype=float))
+
+        self.times = self.book.times
+
+    def npv(self, discount_factors):
+
+        # discount_factors at the dates of self.times
+        return self.notionals * self.book.calc_receiver_IRS_NPV(None, self.fixed_rates, discount_factors)
+
+    def npv_gradient(self):
+
+        # (num_trades, num_times) gradients of the trade NPVs with respect to the discount
+        # factors of self.times, which do not depend on the curve (the NPVs are linear in them)
+        return (self.book.calc_NPV_weights(self.fixed_rates) * self.notionals).T
+
+
+class CDSBook:
+
+    def __init__(self, cds_list, spreads, name_index = None, notionals = None):
+
+        # Receiver CDS stacked into padded schedule tensors. name_index gives the row of
+        # the hazard rate matrix (the reference name) of every trade. Default times are
+        # padded with the end date, so padded default probabilities are zero.
+
+        num_trades = len(cds_list)
+
+        self.cds_list = cds_list
+        self.spreads = torch.as_tensor(np.asarray(spreads, dtype=float))
+        self.notionals = torch.ones(num_trades, dtype=torch.float64) if notionals is None \
+                         else torch.as_tensor(np.asarray(notionals, dtype=float))
+        self.name_index = torch.zeros(num_trades, dtype=torch.int64) if name_index is None \
+                          else torch.as_tensor(np.asarray(name_index), dtype=torch.int64)
+        self.recovery_rates = torch.tensor([float(c.recovery_rate) for c in cds_list], dtype=torch.float64)
+
+        end_t = [float(c.end_t) for c in cds_list]
+
+        self.pay_times = pad_rows([c.pay_times.to(torch.float64) for c in cds_list], end_t)
+        self.dcf = pad_rows([c.dcf.to(torch.float64) for c in cds_list], [0.0] * num_trades)
+        self.default_times = pad_rows([c.default_times.to(torch.float64) for c in cds_list], end_t)
+
+        self.num_pay = self.pay_times.shape[1]
+
+        # Discount factor dates: pay times, then default times but the first
+        self.times = torch.cat((self.pay_times, self.default_times[:, 1:]), dim=1)
+
+    def calc_DV01_DL(self, discount_factors, credit_curve):
+
+        # credit_curve has one row per trade (the hazard rates of its name)
+        surv_probs_pay_times = credit_curve.calc_survival_prob_by_row(self.pay_times)
+        surv_probs_default_times = credit_curve.calc_survival_prob_by_row(self.default_times)
+
+        dflt_probs = surv_probs_default_times[:, :-1] - surv_probs_default_times[:, 1:]
+
+        dv01 = torch.sum(self.dcf * discount_factors[:, :self.num_pay] * surv_probs_pay_times, dim=-1)
+        dl = (1.0 - self.recovery_rates) * torch.sum(discount_factors[:, self.num_pay:] * dflt_probs, dim=-1)
+
+        return dv01, dl
+
+    def npv(self, discount_factors, credit_curve):
+
+        dv01, dl = self.calc_DV01_DL(discount_factors, credit_curve)
+
+        return self.notionals * (dv01 * self.spreads - dl)
+
+
+class BookRisk:
+
+    def __init__(self, ir_time_pillars, zero_rates, swap_book = None, cds_book = None,
+                 credit_maturities = None, lambdas = None):
+
+        # Book level sensitivities of a SwapBook and a CDSBook priced on one IR_Curve and a
+        # matrix of hazard rates (num_names, num_credit_pillars) at credit_maturities.
+        # Deltas are value changes per unit change of a pillar (multiply by 1e-4 for bp).
+
+        self.ir_time_pillars = torch.as_tensor(np.asarray(ir_time_pillars, dtype=float))
+        self.zero_rates = torch.as_tensor(np.asarray(zero_rates, dtype=float))
+        self.swap_book = swap_book
+        self.cds_book = cds_book
+
+        if cds_book is not None:
+            self.credit_maturities = torch.as_tensor(np.asarray(credit_maturities, dtype=float))
+            self.lambdas = torch.as_tensor(np.atleast_2d(np.asarray(lambdas, dtype=float)))
+
+        # All the trades read their discount factors from the union of their dates
+        books = [b for b in (swap_book, cds_book) if b is not None]
+
+        self.df_times, inverse = torch.unique(torch.cat([b.times.reshape(-1) for b in books]), return_inverse=True)
+
+        self.df_index = {}
+        start = 0
+        for b in books:
+            self.df_index[id(b)] = inverse[start:start + b.times.numel()].reshape(b.times.shape)
+            start += b.times.numel()
+
+    def discount_factors(self, zero_rates):
+
+        return IR_Curve(self.ir_time_pillars, zero_rates).discount_factors(self.df_times)
+
+    def values(self):
+
+        with torch.no_grad():
+
+            discount_factors = self.discount_factors(self.zero_rates)
+            values = {}
+
+            if self.swap_book is not None:
+                values['swap_values'] = self.swap_book.npv(discount_factors[self.df_index[id(self.swap_book)]])
+
+            if self.cds_book is not None:
+                credit_curve = Credit_Curve(self.credit_maturities, self.lambdas[self.cds_book.name_index])
+                values['cds_values'] = self.cds_book.npv(discount_factors[self.df_index[id(self.cds_book)]], credit_curve)
+
+        return values
+
+    def key_rate_sensitivities(self):
+
+        # Every CDS is priced in one vectorized call on its own copy of the discount factors
+        # it needs and of the hazard rates of its name. Trades do not share copies, so a
+        # single backward pass of the summed book value gives the gradient of each trade
+        # with respect to its copies. Swaps share the discount factors of their IR_Swap_Book
+        # dates; their NPVs are linear in them, with the gradients of SwapBook.npv_gradient.
+        # The discount factor gradients are mapped to the zero-rate pillars with the
+        # Jacobian of the discount factors of the union dates, taken in forward mode (one
+        # pass per pillar).
+
+        discount_factors = self.discount_factors(self.zero_rates).detach()
+
+        results = {}
+
+        if self.swap_book is not None:
+            swap_df = discount_factors[self.df_index[id(self.swap_book)]]
+            swap_values = self.swap_book.npv(swap_df)
+
+        if self.cds_book is not None:
+            cds_df = discount_factors[self.df_index[id(self.cds_book)]].requires_grad_()
+            cds_lambdas = self.lambdas[self.cds_book.name_index].clone().requires_grad_()
+            cds_values = self.cds_book.npv(cds_df, Credit_Curve(self.credit_maturities, cds_lambdas))
+            cds_values.sum().backward()
+
+        df_jacobian = torch.autograd.functional.jacobian(self.discount_factors, self.zero_rates,
+                                                         vectorize=True, strategy='forward-mode')
+
+        if self.swap_book is not None:
+            results['swap_values'] = swap_values.detach()
+            results['swap_zero_delta'] = self.swap_book.npv_gradient() @ df_jacobian[self.df_index[id(self.swap_book)]]
+
+        if self.cds_book is not None:
+            results['cds_values'] = cds_values.detach()
+            results['cds_zero_delta'] = self.chain_rule(cds_df.grad, self.df_index[id(self.cds_book)], df_jacobian)
+            # Sensitivity to the hazard pillars of the trade's own name
+            results['cds_hazard_delta'] = cds_lambdas.grad
+
+        self.sensitivities = results
+
+        return results
+
+    def chain_rule(self, gradient, index, df_jacobian):
+
+        # (num_trades, num_dates) gradients with respect to the trade discount factors times
+        # d discount factor / d zero rate of the union dates, as a sparse trade x date matrix
+        rows = torch.arange(gradient.shape[0]).unsqueeze(1).expand_as(index)
+
+        matrix = torch.sparse_coo_tensor(torch.stack((rows.reshape(-1), index.reshape(-1))), gradient.reshape(-1),
+                                         (gradient.shape[0], len(self.df_times)), check_invariants=True)
+
+        return torch.sparse.mm(matrix, df_jacobian)
+
+    def par_sensitivities(self, swap_delta_t = 1.0, cds_pay_delta_t = 0.25, cds_default_delta_t = 0.25,
+                          recovery_rates = 0.4):
+
+        # Sensitivities to the market quotes the curves are calibrated to, by the implicit
+        # function theorem. The zero curve reprices par swaps IR_Swap(0, T, swap_delta_t)
+        # at every IR pillar (as CurveFitter): dz/ds = (d par / dz)^-1. Each name's hazard
+        # curve reprices CDS(0, T, ...) at every credit maturity, G(z, lambda, c) = 0, so
+        # dlambda/dc = -(dG/dlambda)^-1 dG/dc and dlambda/dz = -(dG/dlambda)^-1 dG/dz: CDS
+        # trades also move with the swap quotes through their re-bootstrapped hazard rates.
+
+        sens = getattr(self, 'sensitivities', None)
+        if sens is None:
+            sens = self.key_rate_sensitivities()
+
+        z = self.zero_rates
+
+        par_swaps = IR_Swap_Book([IR_Swap(0, t, swap_delta_t) for t in self.ir_time_pillars.tolist()])
+        par_jacobian = torch.autograd.functional.jacobian(
+            lambda x: par_swaps.calc_par_rate(IR_Curve(self.ir_time_pillars, x)), z, vectorize=True)
+
+        results = {}
+
+        if self.swap_book is not None:
+            results['swap_par_delta'] = torch.linalg.solve(par_jacobian, sens['swap_zero_delta'], left=False)
+
+        if self.cds_book is None:
+            return results
+
+        num_names, num_pillars = self.lambdas.shape
+        recovery_rates = np.broadcast_to(np.asarray(recovery_rates, dtype=float), (num_names,))
+
+        pillar_book = CDSBook([CDS(0, T, cds_pay_delta_t, cds_default_delta_t, recovery_rates[n])
+                               for n in range(num_names) for T in self.credit_maturities.tolist()],
+                              np.zeros(num_names * num_pillars),
+                              name_index = np.repeat(np.arange(num_names), num_pillars))
+
+        pillar_times, pillar_inverse = torch.unique(pillar_book.times, return_inverse=True)
+
+        def pillar_dv01_dl(zero_rates, lambdas):
+            discount_factors = IR_Curve(self.ir_time_pillars, zero_rates).discount_factors(pillar_times)[pillar_inverse]
+            return pillar_book.calc_DV01_DL(discount_factors, Credit_Curve(self.credit_maturities, lambdas[pillar_book.name_index]))
+
+        with torch.no_grad():
+            dv01, dl = pillar_dv01_dl(z, self.lambdas)
+
+        # Par spreads of the pillar CDS on the current curves, the quotes they were fitted to
+        spreads = dl / dv01
+
+        def pillar_npv(zero_rates, lambdas):
+            dv01, dl = pillar_dv01_dl(zero_rates, lambdas)
+            return (dv01 * spreads - dl).reshape(num_names, num_pillars)
+
+        # Names are independent: the Jacobian of the sum over names gives every name's block
+        dG_dlambda = torch.autograd.functional.jacobian(lambda x: pillar_npv(z, x).sum(0), self.lambdas,
+                                                        vectorize=True).permute(1, 0, 2)
+        dG_dz = torch.autograd.functional.jacobian(lambda x: pillar_npv(x, self.lambdas), z,
+                                                   vectorize=True, strategy='forward-mode')
+
+        dlambda_dc = -torch.linalg.solve(dG_dlambda, torch.diag_embed(dv01.reshape(num_names, num_pillars)))
+        dlambda_dz = -torch.linalg.solve(dG_dlambda, dG_dz)
+
+        hazard_delta = sens['cds_hazard_delta']
+        names = self.cds_book.name_index
+
+        cds_zero_delta = sens['cds_zero_delta'].clone()
+        cds_spread_delta = torch.zeros_like(hazard_delta)
+
+        for p in range(num_pillars):
+            cds_zero_delta += hazard_delta[:, p:p+1] * dlambda_dz[names, p]
+            cds_spread_delta += hazard_delta[:, p:p+1] * dlambda_dc[names, p]
+
+        results['cds_par_delta'] = torch.linalg.solve(par_jacobian, cds_zero_delta, left=False)
+        results['cds_spread_delta'] = cds_spread_delta
+
+        return results
@@ -1,27 +1,66 @@
 
 import torch
 import numpy as np
+import functools
 from scipy.optimize import fsolve
+from pytorch_ir_curve import DiscountFactorCache
+
+# Discount factors of CDS schedules, shared by every CDS priced on the same curve. The
+# cache is bounded by bytes (64 MB, see DiscountFactorCache); clear_caches releases it
+discount_factor_cache = DiscountFactorCache(max_bytes = 64 * 2**20)
+
+
+def clear_caches():
+
+    # Drops the cached discount factors and the interned schedules
+    discount_factor_cache.clear()
+    cds_schedule.cache_clear()
+
+
+# A schedule is three 1-D tensors of a few KB at most, so the entry count bounds its memory
+@functools.lru_cache(maxsize = 1024)
+def cds_schedule(star_t, end_t, pay_delta_t, default_delta_t):
+
+    # Interned schedules: CDS with the same terms share the same (read only) tensors
+
+    pay_times = torch.tensor(np.concatenate(([star_t], np.arange(end_t, star_t, -pay_delta_t)[::-1])))
+    default_times = torch.tensor(np.concatenate(([star_t], np.arange(end_t, star_t, -default_delta_t)[::-1])))
+    dcf = pay_times[1:] - pay_times[:-1]
+
+    return pay_times[1:], default_times, dcf
+
 
 class Credit_Curve():
 
     def __init__(self, maturities, lambdas):
+
+        # lambdas may be a (num_names, num_pillars) tensor of hazard rates over shared
+        # maturities; survival probabilities are then returned as (num_names, num_times).
+
         self.maturities = torch.concatenate((torch.tensor([0.0]),maturities))
         self.lambdas = lambdas 
 
-        self.surv_probs = torch.zeros_like(self.maturities)
-        self.surv_probs[0] = 1.0
-
-        self.surv_probs[1:] = torch.exp(-self.lambdas*(self.maturities[1:] - self.maturities[:-1]))
+        self.surv_probs = torch.exp(-self.lambdas*(self.maturities[1:] - self.maturities[:-1]))
+        self.surv_probs = torch.cat((torch.ones_like(self.surv_probs[..., :1]), self.surv_probs), dim=-1)
 
-        self.surv_probs = torch.cumprod(self.surv_probs, dim =0)
+        self.surv_probs = torch.cumprod(self.surv_probs, dim=-1)
 
     def calc_survival_prob(self, t):
 
         index = torch.searchsorted(self.maturities, t, right=True)
 
-        index = torch.clamp(index, min=0, max=len(self.lambdas))
-        return self.surv_probs[index-1] * torch.exp(-self.lambdas[index-1] * (t - self.maturities[index-1])) 
+        index = torch.clamp(index, min=0, max=self.lambdas.shape[-1])
+        return self.surv_probs[..., index-1] * torch.exp(-self.lambdas[..., index-1] * (t - self.maturities[index-1])) 
+
+    def calc_survival_prob_by_row(self, t):
+
+        # Row k of a (num_rows, num_pillars) curve at its own times t[k], t of shape
+        # (num_rows, num_times): a book of trades, each on the hazard rates of its name
+
+        index = torch.searchsorted(self.maturities, t, right=True)
+
+        index = torch.clamp(index, min=0, max=self.lambdas.shape[-1])
+        return self.surv_probs.gather(-1, index-1) * torch.exp(-self.lambdas.gather(-1, index-1) * (t - self.maturities[index-1]))
     
 
     
@@ -35,24 +74,22 @@ class CDS:
         self.default_delta_t = default_delta_t
         self.recovery_rate = recovery_rate
         
-        
-        self.pay_times = torch.tensor(np.concatenate(([star_t], np.arange(end_t, star_t, -pay_delta_t)[::-1])))
-        self.default_times = torch.tensor(np.concatenate(([star_t], np.arange(end_t, star_t, -default_delta_t)[::-1])))
-        self.dcf = self.pay_times[1:] - self.pay_times[:-1]
-        self.pay_times = self.pay_times[1:]
+        self.schedule_key = (float(star_t), float(end_t), float(pay_delta_t), float(default_delta_t))
+        self.pay_times, self.default_times, self.dcf = cds_schedule(*self.schedule_key)
 
 
     def calc_DV01_DL(self, ir_curve, credit_curve):
 
-        discount_factors_pay_times = ir_curve.discount_factors(self.pay_times)
-        discount_factors_default_times  = ir_curve.discount_factors(self.default_times[1:])
+        discount_factors_pay_times = discount_factor_cache.discount_factors(ir_curve, self.pay_times, self.schedule_key + ('pay',))
+        discount_factors_default_times  = discount_factor_cache.discount_factors(ir_curve, self.default_times[1:], self.schedule_key + ('default',))
         surv_probs_pay_times = credit_curve.calc_survival_prob(self.pay_times)
         surv_probs_default_times = credit_curve.calc_survival_prob(self.default_times) 
         
-        dflt_probs = surv_probs_default_times[:-1] - surv_probs_default_times[1:]
+        dflt_probs = surv_probs_default_times[..., :-1] - surv_probs_default_times[..., 1:]
 
-        dv01 = torch.sum(self.dcf * discount_factors_pay_times * surv_probs_pay_times)
-        dl = (1.0 - self.recovery_rate)*torch.sum(discount_factors_default_times * dflt_probs)
+        # Sums run over the last axis so that batched curves give one value per scenario
+        dv01 = torch.sum(self.dcf * discount_factors_pay_times * surv_probs_pay_times, dim=-1)
+        dl = (1.0 - self.recovery_rate)*torch.sum(discount_factors_default_times * dflt_probs, dim=-1)
 
         return dv01, dl 
     
@@ -97,14 +134,182 @@ class CreditCurveFitter:
         
         return model_cds 
     
-    def fit(self):
+    def fit(self, method = 'newton', tol = 1e-14, max_iter = 50):
+
+        # 'newton' runs the safeguarded CDSBootstrapper, which falls back to 'fsolve' by
+        # itself when a pillar does not converge. Both fill self.report.
+
+        if method == 'newton':
 
+            bootstrapper = CDSBootstrapper(self.time_pillars, self.pay_delta_t, self.default_delta_t, self.ir_curve)
+
+            self.default_intens, self.report = bootstrapper.fit(self.CDS_rates, self.recovery_rate, tol = tol, max_iter = max_iter)
+            self.num_calibrations = len(self.default_intens)
+
+            return self.default_intens.copy()
+
+        self.report = {'iterations': np.zeros(len(self.default_intens), dtype=int),
+                       'residuals': np.zeros(len(self.default_intens)),
+                       'converged': np.zeros(len(self.default_intens), dtype=bool)}
 
         for i in range(len(self.default_intens)):
 
-            self.default_intens[i] = fsolve(self.residuals, 0.0)
+            x, info, ier, _ = fsolve(self.residuals, 0.0, full_output = True)
+
+            self.default_intens[i] = x[0]
+            self.report['iterations'][i] = info['nfev']
+            self.report['residuals'][i] = np.ravel(info['fvec'])[0]
+            self.report['converged'][i] = ier == 1
 
             self.num_calibrations += 1
         
 
-        return self.default_intens.copy()
\ No newline at end of file
+        return self.default_intens.copy()
+
+
+class CDSBootstrapper:
+
+    def __init__(self, time_pillars, pay_delta_t, default_delta_t, ir_curve):
+
+        # Pay / default schedules of the CDS quoted at each pillar and their discount
+        # factors are computed once. For every schedule time we also store the hazard
+        # segment it falls in (same convention as Credit_Curve.calc_survival_prob) and
+        # its distance to the start of that segment.
+
+        self.time_pillars = np.asarray(time_pillars, dtype=float)
+        self.maturities = np.concatenate(([0.0], self.time_pillars))
+
+        self.pay_delta_t = pay_delta_t
+        self.default_delta_t = default_delta_t
+        self.ir_curve = ir_curve
+
+        self.schedules = []
+
+        for k, end_t in enumerate(self.time_pillars):
+
+            cds = CDS(0, end_t, pay_delta_t, default_delta_t, 0.0)
+
+            pay_times = cds.pay_times.numpy()
+            default_times = cds.default_times.numpy()
+
+            with torch.no_grad():
+                df_pay = ir_curve.discount_factors(cds.pay_times).numpy()
+                df_default = ir_curve.discount_factors(cds.default_times[1:]).numpy()
+
+            self.schedules.append({'dcf_df': cds.dcf.numpy() * df_pay,
+                                   'df_default': df_default,
+                                   'pay': self.segments(pay_times, k),
+                                   'default': self.segments(default_times, k)})
+
+    def segments(self, times, k):
+
+        segment = np.clip(np.searchsorted(self.maturities[:k+2], times, side='right'), 1, k+1) - 1
+
+        return segment, times - self.maturities[segment], segment == k
+
+    def survival(self, pillar_surv, lambdas, new_lambda, segments):
+
+        # Survival probabilities at the schedule times and their derivative with respect
+        # to the hazard rate being solved. Only times in the new segment depend on it.
+
+        segment, tau, is_new = segments
+
+        hazard = np.where(is_new, new_lambda[..., None], lambdas[..., np.minimum(segment, lambdas.shape[-1]-1)])
+
+        surv = pillar_surv[..., segment] * np.exp(-hazard * tau)
+
+        return surv, np.where(is_new, -tau * surv, 0.0)
+
+    def fit(self, CDS_rates, recovery_rate, tol = 1e-14, max_iter = 50):
+
+        # CDS_rates is (..., num_pillars) and recovery_rate broadcasts against CDS_rates[..., 0],
+        # so many names are bootstrapped at once. Each pillar is a scalar Newton problem per
+        # name with analytic derivative; the already solved segments stay frozen.
+        # Quoted names whose Newton bootstrap fails at some pillar are recalibrated one by
+        # one with CreditCurveFitter's fsolve path; report['fallback'] flags them.
+
+        CDS_rates = np.asarray(CDS_rates, dtype=float)
+        loss_given_default = 1.0 - np.broadcast_to(np.asarray(recovery_rate, dtype=float), CDS_rates.shape[:-1])
+
+        num_pillars = len(self.time_pillars)
+
+        lambdas = np.zeros(CDS_rates.shape)
+        pillar_surv = np.ones(CDS_rates.shape[:-1] + (num_pillars + 1,))
+
+        iterations = np.zeros(CDS_rates.shape, dtype=int)
+        residuals = np.zeros(CDS_rates.shape)
+
+        converged = np.zeros(CDS_rates.shape, dtype=bool)
+
+        # Names without quotes propagate nan silently
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            self.bootstrap(CDS_rates, loss_given_default, lambdas, pillar_surv, iterations, residuals, converged, tol, max_iter)
+
+        fallback = np.isfinite(CDS_rates).all(axis=-1) & ~converged.all(axis=-1)
+
+        for index in map(tuple, np.argwhere(fallback)):
+
+            fitter = CreditCurveFitter(self.time_pillars, CDS_rates[index], self.pay_delta_t, self.default_delta_t,
+                                       1.0 - loss_given_default[index], self.ir_curve)
+
+            lambdas[index] = fitter.fit('fsolve')
+
+            iterations[index] = fitter.report['iterations']
+            residuals[index] = fitter.report['residuals']
+            converged[index] = fitter.report['converged']
+
+        return lambdas, {'iterations': iterations, 'residuals': residuals, 'converged': converged, 'fallback': fallback}
+
+    def bootstrap(self, CDS_rates, loss_given_default, lambdas, pillar_surv, iterations, residuals, converged, tol, max_iter):
+
+        # The receiver NPV decreases with the hazard rate of the new segment (less premium,
+        # more protection), so every evaluation narrows a bracket [lo, hi] around the root
+        # in [0, inf). Newton steps that leave the bracket are replaced by bisection (or by
+        # doubling while no upper end is known), which keeps the hazard non-negative and
+        # finite. A pillar converges when the NPV is within tol or the bracket has shrunk to
+        # round off; a root below zero leaves it unconverged.
+
+        eps = np.finfo(float).eps
+
+        for k, schedule in enumerate(self.schedules):
+
+            rate = CDS_rates[..., k]
+
+            lo = np.zeros(rate.shape)
+            hi = np.full(rate.shape, np.inf)
+
+            # Credit triangle as first guess
+            new_lambda = rate / loss_given_default
+
+            for it in range(max_iter + 1):
+
+                surv_pay, d_surv_pay = self.survival(pillar_surv, lambdas, new_lambda, schedule['pay'])
+                surv_def, d_surv_def = self.survival(pillar_surv, lambdas, new_lambda, schedule['default'])
+
+                dv01 = np.sum(schedule['dcf_df'] * surv_pay, axis=-1)
+                dl = loss_given_default * np.sum(schedule['df_default'] * (surv_def[..., :-1] - surv_def[..., 1:]), axis=-1)
+
+                npv = dv01 * rate - dl
+
+                d_dv01 = np.sum(schedule['dcf_df'] * d_surv_pay, axis=-1)
+                d_dl = loss_given_default * np.sum(schedule['df_default'] * (d_surv_def[..., :-1] - d_surv_def[..., 1:]), axis=-1)
+
+                lo = np.where(npv > 0, new_lambda, lo)
+                hi = np.where(npv < 0, new_lambda, hi)
+
+                done = (np.abs(npv) <= tol) | ((lo > 0) & np.isfinite(hi) & (hi - lo <= 4 * eps * hi))
+                active = ~done & np.isfinite(npv)
+
+                if it == max_iter or not np.any(active):
+                    break
+
+                step = new_lambda - npv / (d_dv01 * rate - d_dl)
+                safe = np.where(np.isinf(hi), 2 * lo + 1.0, 0.5 * (lo + hi))
+
+                new_lambda = np.where(active, np.where((step > lo) & (step < hi), step, safe), new_lambda)
+                iterations[..., k] += active
+
+            residuals[..., k] = npv
+            converged[..., k] = done
+            lambdas[..., k] = new_lambda
+            pillar_surv[..., k+1] = pillar_surv[..., k] * np.exp(-new_lambda * (self.maturities[k+1] - self.maturities[k]))
@@ -1,14 +1,26 @@
 import torch
 import pytorch_spline
 import numpy as np
+import itertools
+from collections import OrderedDict
 from scipy.optimize import fsolve
 
+# Curves are immutable once built, so a counter identifies a curve (and its version)
+# without the reuse problems of id()
+_curve_ids = itertools.count()
+
 class IR_Curve:
 
     def __init__(self, time_pillars, rates):
 
+        self.curve_id = next(_curve_ids)
+
+        # rates may be a (num_scenarios, num_pillars) tensor: all the scenario curves share
+        # the spline knots and are built at once, and zero_coupon_rates / discount_factors
+        # then return (num_scenarios, num_times) tensors.
+
         time_pillars = torch.concatenate([torch.tensor([0]), time_pillars])
-        rates = torch.concatenate([torch.tensor([0]), rates])
+        rates = torch.concatenate([torch.zeros(rates.shape[:-1] + (1,), dtype=rates.dtype), rates], dim=-1)
         time_times_rate = rates * time_pillars
 
         self.interpolator = pytorch_spline.NaturalCubicSpline_Torch(time_pillars,time_times_rate)
@@ -20,8 +32,67 @@ class IR_Curve:
     def discount_factors(self, time_pillars):
 
         return torch.exp(-self.interpolator.evaluate_spline(time_pillars))
+
+    @property
+    def requires_grad(self):
+
+        return self.interpolator.fx.requires_grad
     
 
+class DiscountFactorCache:
+
+    def __init__(self, max_bytes = 64 * 2**20):
+
+        # LRU of discount factors keyed by (curve_id, time grid key), bounded by the
+        # memory of the cached tensors (a batched curve caches a whole scenarios x times
+        # matrix per grid). Least recently used entries are evicted past max_bytes and
+        # tensors larger than max_bytes are not cached at all. Curves that track
+        # gradients are never cached: reusing a tensor attached to an autograd graph
+        # would break a second backward pass.
+
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def discount_factors(self, ir_curve, times, key = None):
+
+        # Curves without curve_id (any object with a discount_factors method) are not cached
+        if not hasattr(ir_curve, 'curve_id') or getattr(ir_curve, 'requires_grad', False):
+            return ir_curve.discount_factors(times)
+
+        if key is None:
+            key = (tuple(times.shape), times.numpy().tobytes())
+
+        key = (ir_curve.curve_id, key)
+
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        self.misses += 1
+
+        discount_factors = ir_curve.discount_factors(times)
+
+        if discount_factors.nbytes <= self.max_bytes:
+
+            self.entries[key] = discount_factors
+            self.nbytes += discount_factors.nbytes
+
+            while self.nbytes > self.max_bytes:
+                self.nbytes -= self.entries.popitem(last = False)[1].nbytes
+
+        return discount_factors
+
+    def clear(self):
+
+        self.entries.clear()
+        self.nbytes = 0
+
+
+
 class IR_Swap:
 
     def __init__(self, star_t, end_t, delta_t):
@@ -37,7 +108,7 @@ class IR_Swap:
     def calc_PV01(self, ir_curve):
 
         discount_factors = ir_curve.discount_factors(self.pay_times)
-        return torch.sum(self.dcf * discount_factors)
+        return torch.sum(self.dcf * discount_factors, dim=-1)
     
     def calc_par_rate(self, ir_curve):
 
@@ -50,21 +121,199 @@ class IR_Swap:
         PV01 = self.calc_PV01(ir_curve)
         return PV01 * par_rate - ir_curve.discount_factors(self.star_t) + ir_curve.discount_factors(self.end_t)
     
+class IR_Swap_Book:
+
+    def __init__(self, swaps):
+
+        # Maps the schedules of several swaps onto the union of their pay, start and end
+        # times. The day count fractions become a (num_times, num_swaps) matrix, so the
+        # PV01 of the whole book is one discount factor evaluation and a matmul.
+
+        self.swaps = swaps
+
+        all_times = torch.cat([torch.cat((torch.tensor([float(s.star_t), float(s.end_t)], dtype=torch.float64),
+                                          s.pay_times.to(torch.float64))) for s in swaps])
+        self.times = torch.unique(all_times)
+
+        self.dcf_matrix = torch.zeros((len(self.times), len(swaps)), dtype=torch.float64)
+
+        for k, s in enumerate(swaps):
+            self.dcf_matrix[torch.searchsorted(self.times, s.pay_times.to(torch.float64)), k] += s.dcf
+
+        self.star_index = torch.searchsorted(self.times, torch.tensor([float(s.star_t) for s in swaps], dtype=torch.float64))
+        self.end_index = torch.searchsorted(self.times, torch.tensor([float(s.end_t) for s in swaps], dtype=torch.float64))
+
+    def calc_discount_factors(self, ir_curve):
+
+        return ir_curve.discount_factors(self.times)
+
+    def calc_PV01(self, ir_curve, discount_factors = None):
+
+        if discount_factors is None:
+            discount_factors = self.calc_discount_factors(ir_curve)
+
+        return discount_factors @ self.dcf_matrix
+
+    def calc_par_rate(self, ir_curve, discount_factors = None):
+
+        if discount_factors is None:
+            discount_factors = self.calc_discount_factors(ir_curve)
+
+        PV01 = self.calc_PV01(ir_curve, discount_factors)
+
+        return (discount_factors[..., self.star_index] - discount_factors[..., self.end_index]) / PV01
+
+    def calc_NPV_weights(self, par_rate):
+
+        # Receiver NPVs are linear in the discount factors at self.times, NPV = discount
+        # factors @ weights: column k of the (num_times, num_swaps) weights is the gradient
+        # of the NPV of swap k with respect to them.
+        swaps = torch.arange(len(self.swaps))
+        one = torch.tensor(1.0, dtype=torch.float64)
+
+        weights = self.dcf_matrix * par_rate
+        weights = weights.index_put((self.star_index, swaps), -one, accumulate=True)
+        weights = weights.index_put((self.end_index, swaps), one, accumulate=True)
+
+        return weights
+
+    def calc_receiver_IRS_NPV(self, ir_curve, par_rate, discount_factors = None):
+
+        # discount_factors (at self.times) may be given instead of the curve
+        if discount_factors is None:
+            discount_factors = self.calc_discount_factors(ir_curve)
+
+        PV01 = self.calc_PV01(ir_curve, discount_factors)
+
+        return PV01 * par_rate - discount_factors[..., self.star_index] + discount_factors[..., self.end_index]
+
+
+def levenberg_marquardt(residuals, x0, tol = 1e-12, max_iter = 50, damping = 1e-6):
+
+    # Solves residuals(x) = 0 row by row for x of shape (num_problems, num_unknowns),
+    # where row b of the residuals only depends on row b of x. The exact Jacobians of
+    # all rows come from one vectorized reverse pass over residuals(x).sum(0). Each row
+    # has its own damping: it shrinks on accepted steps (Newton near the root) and grows
+    # when a step does not reduce the residual.
+
+    x = x0.detach().clone()
+    lambdas = torch.full(x.shape[:1], damping, dtype=x.dtype)
+
+    r = residuals(x).detach()
+    norm = torch.sum(r**2, dim=-1)
+
+    iterations = torch.zeros(x.shape[:1], dtype=torch.int64)
+
+    for it in range(max_iter):
+
+        active = torch.max(torch.abs(r), dim=-1).values > tol
+
+        if not torch.any(active):
+            break
+
+        J = torch.autograd.functional.jacobian(lambda y: residuals(y).sum(0), x, vectorize=True).permute(1, 0, 2)
+
+        JtJ = J.transpose(1, 2) @ J
+        A = JtJ + lambdas[:, None, None] * torch.diag_embed(torch.diagonal(JtJ, dim1=1, dim2=2))
+        step = torch.linalg.solve(A, -(J.transpose(1, 2) @ r.unsqueeze(-1))).squeeze(-1)
+
+        x_trial = x + step * active[:, None]
+        r_trial = residuals(x_trial).detach()
+        norm_trial = torch.sum(r_trial**2, dim=-1)
+
+        accept = active & (norm_trial < norm)
+
+        x = torch.where(accept[:, None], x_trial, x)
+        r = torch.where(accept[:, None], r_trial, r)
+        norm = torch.where(accept, norm_trial, norm)
+
+        lambdas = torch.where(accept, lambdas / 10.0, torch.where(active, lambdas * 10.0, lambdas))
+        iterations += active
+
+    max_residual = torch.max(torch.abs(r), dim=-1).values
+
+    return x, {'iterations': iterations, 'max_residual': max_residual, 'converged': max_residual <= tol}
+
+
 class CurveFitter:
     def __init__(self, time_pillars, swap_rates, delta_t):
         self.time_pillars = time_pillars
         self.swap_rates = swap_rates
         self.delta_t = delta_t
-        
-    def residuals(self, x):
 
-        curve = IR_Curve(torch.tensor(self.time_pillars), torch.tensor(x))
-        swap = [IR_Swap(0, t, self.delta_t) for t in self.time_pillars]
+        # Swap schedules do not change between iterations, build them once
+        self.swaps = IR_Swap_Book([IR_Swap(0, t, self.delta_t) for t in self.time_pillars])
+        self.time_pillars_tensor = torch.tensor(self.time_pillars, dtype=torch.float64)
+        self.swap_rates_tensor = torch.tensor(self.swap_rates, dtype=torch.float64)
+
+    def residuals_tensor(self, x):
+
+        curve = IR_Curve(self.time_pillars_tensor, x)
+
+        return self.swaps.calc_par_rate(curve) - self.swap_rates_tensor
 
-        return [s.calc_par_rate(curve).item() for s in swap] - self.swap_rates
+    def residuals(self, x):
+
+        with torch.no_grad():
+            return self.residuals_tensor(torch.tensor(x)).numpy()
     
-    def fit(self):
-        
-        zc_rates = fsolve(self.residuals, self.swap_rates)
+    def fit(self, method = 'newton', tol = 1e-12, max_iter = 50):
+
+        if method == 'fsolve':
+            return fsolve(self.residuals, self.swap_rates)
+
+        zc_rates, self.report = levenberg_marquardt(self.residuals_tensor, self.swap_rates_tensor.reshape(1, -1),
+                                                    tol = tol, max_iter = max_iter)
+
+        return zc_rates[0].numpy()
+
+class BatchCurveFitter:
+    def __init__(self, time_pillars, swap_rates, delta_t, chunk_size = 250):
+
+        # swap_rates is a (num_dates, num_pillars) matrix of par swap rates, one curve per row.
+        # Dates are calibrated chunk by chunk, all the curves of a chunk simultaneously.
+
+        self.time_pillars = time_pillars
+        self.swap_rates = swap_rates
+        self.delta_t = delta_t
+        self.chunk_size = chunk_size
+
+        self.swaps = IR_Swap_Book([IR_Swap(0, t, self.delta_t) for t in self.time_pillars])
+        self.time_pillars_tensor = torch.tensor(self.time_pillars, dtype=torch.float64)
+        self.swap_rates_tensor = torch.tensor(np.asarray(self.swap_rates), dtype=torch.float64)
+
+    def fit(self, tol = 1e-12, max_iter = 50):
+
+        num_dates = self.swap_rates_tensor.shape[0]
+
+        zc_rates = torch.zeros_like(self.swap_rates_tensor)
+        iterations = torch.zeros(num_dates, dtype=torch.int64)
+        max_residual = torch.zeros(num_dates, dtype=torch.float64)
+
+        for start in range(0, num_dates, self.chunk_size):
+
+            end = min(start + self.chunk_size, num_dates)
+            swap_rates = self.swap_rates_tensor[start:end]
+
+            # Warm start: the first chunk starts from the par rates, the next ones from the
+            # previous date's zero curve moved by the change in par rates
+            if start == 0:
+                x0 = swap_rates
+            else:
+                x0 = zc_rates[start-1] + swap_rates - self.swap_rates_tensor[start-1]
+
+            def residuals(x):
+                curve = IR_Curve(self.time_pillars_tensor, x)
+                return self.swaps.calc_par_rate(curve) - swap_rates
+
+            x, report = levenberg_marquardt(residuals, x0, tol = tol, max_iter = max_iter)
+
+            zc_rates[start:end] = x
+            iterations[start:end] = report['iterations']
+            max_residual[start:end] = report['max_residual']
+
+        self.report = {'iterations': iterations.numpy(),
+                       'max_residual': max_residual.numpy(),
+                       'converged': (max_residual <= tol).numpy()}
 
-        return zc_rates
\ No newline at end of file
+        return zc_rates.numpy()
@@ -0,0 +1,227 @@
+import torch
+import numpy as np
+import risk_metrics
+from pytorch_ir_curve import IR_Curve, IR_Swap_Book
+
+
+class IncrementalCovariance:
+
+    def __init__(self, num_variables):
+
+        # Running mean and covariance of a stream of observations (rows), updated one batch
+        # at a time with the pairwise formulas of Chan et al., so new dates can be added
+        # without keeping the history. Two accumulators can be merged.
+
+        self.count = 0
+        self.mean = np.zeros(num_variables)
+        self.scatter = np.zeros((num_variables, num_variables))
+
+    def update(self, observations):
+
+        observations = np.atleast_2d(np.asarray(observations, dtype = float))
+
+        if len(observations) == 0:
+            return self
+
+        batch_count = len(observations)
+        batch_mean = observations.mean(axis = 0)
+        centered = observations - batch_mean
+
+        return self.combine(batch_count, batch_mean, centered.T @ centered)
+
+    def merge(self, other):
+
+        return self.combine(other.count, other.mean, other.scatter)
+
+    def combine(self, count, mean, scatter):
+
+        total = self.count + count
+        delta = mean - self.mean
+
+        self.scatter = self.scatter + scatter + np.outer(delta, delta) * self.count * count / total
+        self.mean = self.mean + delta * count / total
+        self.count = total
+
+        return self
+
+    def covariance(self, ddof = 1):
+
+        return self.scatter / (self.count - ddof)
+
+    def correlation(self):
+
+        std = np.sqrt(np.diag(self.scatter))
+
+        return self.scatter / np.outer(std, std)
+
+
+class CurvePCA:
+
+    def __init__(self, tenors, num_components = 3, standardize = False):
+
+        # PCA of daily changes of a curve sampled on tenors. With standardize = True the
+        # decomposition is done on the correlation matrix, as with StandardScaler + PCA in
+        # the 11_PCA_IR notebook. Factor i has variance eigenvalues[i] and loadings are in
+        # curve units: row i is the curve move of one unit of factor i (the tenor standard
+        # deviations are folded in when standardized). Eigenvectors are signed so that
+        # their first tenor is positive.
+
+        self.tenors = np.asarray(tenors, dtype = float)
+        self.num_components = num_components
+        self.standardize = standardize
+
+        self.stats = IncrementalCovariance(len(self.tenors))
+
+    def update(self, changes):
+
+        # Adds new rows of curve changes (dates x tenors) and refreshes the factors. The
+        # eigen decomposition is of a tenors x tenors matrix, so it is cheap to redo daily.
+        self.stats.update(changes)
+
+        matrix = self.stats.correlation() if self.standardize else self.stats.covariance()
+
+        eigenvalues, eigenvectors = np.linalg.eigh(matrix)
+        order = np.argsort(eigenvalues)[::-1]
+
+        eigenvalues = eigenvalues[order]
+        eigenvectors = eigenvectors[:, order].T
+        eigenvectors *= np.where(eigenvectors[:, :1] < 0, -1.0, 1.0)
+
+        self.eigenvalues = eigenvalues
+        self.components = eigenvectors[:self.num_components]
+        self.explained_variance_ratio = eigenvalues / eigenvalues.sum()
+
+        scale = np.sqrt(np.diag(self.stats.covariance())) if self.standardize else np.ones(len(self.tenors))
+
+        self.scale = scale
+        self.loadings = self.components * scale
+
+        return self
+
+    fit = update
+
+    def transform(self, changes):
+
+        # Factor scores of curve changes (least squares on the retained components)
+        centered = (np.atleast_2d(changes) - self.stats.mean) / self.scale
+
+        return centered @ self.components.T
+
+    def inverse_transform(self, factors):
+
+        # Curve changes of factor scenarios, (num_scenarios, num_tenors), without drift
+        return np.atleast_2d(factors) @ self.loadings
+
+    def simulate_factors(self, num_scenarios, horizon = 1, rng = None):
+
+        # Independent Gaussian factor scenarios with the PCA variances over horizon days
+        if rng is None:
+            rng = np.random.default_rng()
+
+        std = np.sqrt(self.eigenvalues[:self.num_components] * horizon)
+
+        return rng.standard_normal((num_scenarios, self.num_components)) * std
+
+
+class SwapPortfolioFactorModel:
+
+    def __init__(self, swaps, notionals, fixed_rates, time_pillars, zero_rates, pca):
+
+        # Receiver swaps (IR_Swap) valued on the IR_Curve built from zero_rates at
+        # time_pillars. pca must be fitted on changes of those zero rates, so that a factor
+        # scenario f moves the curve rates by f @ pca.loadings.
+        # The portfolio delta and gamma with respect to the pillar rates are taken once with
+        # autograd through IR_Curve and projected on the factors, after which the P&L of
+        # any number of factor scenarios is a couple of matrix products.
+
+        self.book = IR_Swap_Book(swaps)
+        self.notionals = torch.as_tensor(np.asarray(notionals, dtype = float))
+        self.fixed_rates = torch.as_tensor(np.asarray(fixed_rates, dtype = float))
+        self.time_pillars = torch.as_tensor(np.asarray(time_pillars, dtype = float))
+        self.zero_rates = torch.as_tensor(np.asarray(zero_rates, dtype = float))
+        self.pca = pca
+
+        self.loadings = torch.as_tensor(pca.loadings)
+
+        self.compute_sensitivities()
+
+    def swap_values(self, rates):
+
+        # (..., num_swaps) NPVs per unit notional for (..., num_pillars) zero rates
+        curve = IR_Curve(self.time_pillars, rates)
+
+        return self.book.calc_receiver_IRS_NPV(curve, self.fixed_rates)
+
+    def value(self, rates):
+
+        return self.swap_values(rates) @ self.notionals
+
+    def compute_sensitivities(self):
+
+        rates = self.zero_rates.clone()
+
+        self.base_value = self.value(rates).item()
+
+        # Pillar PV01 of every swap, (num_swaps, num_pillars), and portfolio gamma
+        self.swap_pillar_delta = torch.autograd.functional.jacobian(self.swap_values, rates)
+        self.pillar_delta = self.notionals @ self.swap_pillar_delta
+        self.pillar_gamma = torch.autograd.functional.hessian(self.value, rates)
+
+        # Per-factor loadings: value change per unit move of each factor
+        self.swap_factor_delta = self.swap_pillar_delta @ self.loadings.T
+        self.factor_delta = self.loadings @ self.pillar_delta
+        self.factor_gamma = self.loadings @ self.pillar_gamma @ self.loadings.T
+
+        return self.factor_delta, self.factor_gamma
+
+    def factor_pl(self, factors, second_order = True):
+
+        # Delta(-gamma) P&L of (num_scenarios, num_components) factor scenarios
+        factors = torch.as_tensor(np.asarray(factors, dtype = float))
+
+        pl = factors @ self.factor_delta
+
+        if second_order:
+            pl = pl + 0.5 * torch.sum((factors @ self.factor_gamma) * factors, dim = -1)
+
+        return pl.numpy()
+
+    def full_pl(self, factors, chunk_size = 5000):
+
+        # Full revaluation: one batched IR_Curve per chunk of scenario curves
+        factors = torch.as_tensor(np.atleast_2d(np.asarray(factors, dtype = float)))
+
+        pl = [self.value(self.zero_rates + chunk @ self.loadings) - self.base_value
+              for chunk in torch.split(factors, chunk_size)]
+
+        return torch.cat(pl).numpy()
+
+    def var_es(self, factors, alpha = 0.99, revalue_tail = True, candidates = 3):
+
+        # VaR / ES from the factor P&L. With revalue_tail, the candidates * k worst
+        # scenarios of the approximation (k the tail size) are fully revalued, their exact
+        # P&L replaces the approximation and the figures are recomputed.
+
+        pl_approx = self.factor_pl(factors)
+
+        var_approx, es_approx = risk_metrics.weighted_var_es(pl_approx, None, alpha)
+
+        results = {'pl_approx': pl_approx, 'VaR_approx': var_approx, 'ES_approx': es_approx}
+
+        if not revalue_tail:
+            results.update({'pl': pl_approx, 'VaR': var_approx, 'ES': es_approx})
+            return results
+
+        k = risk_metrics.tail_size(alpha, len(pl_approx))
+        num_revalued = min(candidates * k, len(pl_approx))
+
+        revalued = np.argpartition(pl_approx, num_revalued - 1)[:num_revalued]
+
+        pl = pl_approx.copy()
+        pl[revalued] = self.full_pl(np.asarray(factors)[revalued])
+
+        var, es = risk_metrics.weighted_var_es(pl, None, alpha)
+
+        results.update({'pl': pl, 'VaR': var, 'ES': es, 'revalued': revalued})
+
+        return results
@@ -1,9 +1,12 @@
 import torch
 from torch.distributions import Normal
 
+# Built once and shared by every call
+_normal_dist = Normal(0.0, 1.0)
+
 def bachelier_option_formula(forward, strike, vol, ttm, iscall):
 
-    normal_dist = Normal(0.0, 1.0)
+    normal_dist = _normal_dist
 
     if ttm > 0:
 
@@ -25,6 +28,25 @@ def bachelier_option_formula(forward, strike, vol, ttm, iscall):
             return torch.maximum(strike - forward, 0.0)
 
 
+def bachelier_option_formula_batch(forward, strike, vol, ttm, iscall):
+
+    # Branch free version for books of contracts: iscall may be a boolean tensor
+    # and expired contracts (ttm <= 0) are masked to intrinsic value.
+
+    ttm = torch.as_tensor(ttm)
+    omega = torch.where(torch.as_tensor(iscall, dtype=torch.bool), 1.0, -1.0)
+
+    alive = ttm > 0
+    std = vol * torch.sqrt(torch.where(alive, ttm, torch.ones_like(ttm)))
+
+    d = (forward - strike)/std
+
+    value = omega * (forward - strike) * torch.special.ndtr(omega * d) + std * torch.exp(_normal_dist.log_prob(d))
+
+    # + 0.0 turns the -0.0 of expired at the money puts into a clean zero
+    return torch.where(alive, value, torch.relu(omega * (forward - strike)) + 0.0)
+
+
 def BlackScholes(Spot, Strike, TTM, rate, div, Vol, IsCall):
     """
     Calculate the Black-Scholes option pricing model using PyTorch.
@@ -41,7 +63,10 @@ def BlackScholes(Spot, Strike, TTM, rate, div, Vol, IsCall):
     Returns:
     - torch.Tensor: The Black-Scholes price of the option.
     """
-    normal_dist = Normal(0.0, 1.0)
+    if torch.as_tensor(TTM).numel() > 1 or torch.is_tensor(IsCall):  # Book of contracts, use the batched kernel
+        return BlackScholesBatch(Spot, Strike, TTM, rate, div, Vol, IsCall)
+
+    normal_dist = _normal_dist
     N = normal_dist.cdf  # Standard normal cumulative distribution function
 
     if TTM > 0:  # Positive time to maturity
@@ -75,6 +100,81 @@ def forward_price(Spot, Strike, rate, div, TTM):
     return Spot * torch.exp((rate - div) * TTM) - Strike * torch.exp(rate * TTM)
 
 
+def BlackScholesBatch(Spot, Strike, TTM, rate, div, Vol, IsCall):
+    """
+    Black-Scholes price of a book of options using PyTorch, without Python branching.
+
+    All arguments are broadcast together. IsCall may be a boolean tensor so calls and
+    puts are mixed in the same book, and options with TTM <= 0 are masked to intrinsic
+    value, which keeps the whole computation differentiable and vmap friendly.
+
+    Args:
+    - Spot (torch.Tensor): Current price of the underlying asset.
+    - Strike (torch.Tensor): Strike price of the option.
+    - TTM (torch.Tensor): Time to maturity of the option, in years.
+    - rate (torch.Tensor): Risk-free interest rate, as a decimal.
+    - div (torch.Tensor): Dividend yield of the asset, as a decimal.
+    - Vol (torch.Tensor): Volatility of the asset's returns, as a decimal.
+    - IsCall (bool or torch.Tensor): True for call options, False for put options.
+
+    Returns:
+    - torch.Tensor: The Black-Scholes prices, with the broadcast shape of the inputs.
+    """
+    TTM = torch.as_tensor(TTM)
+    omega = torch.where(torch.as_tensor(IsCall, dtype=torch.bool), 1.0, -1.0)  # +1 calls, -1 puts
+
+    alive = TTM > 0
+    T = torch.where(alive, TTM, torch.ones_like(TTM))  # Dummy maturity keeps expired options finite
+    sqrt_T = torch.sqrt(T)
+
+    d1 = (torch.log(Spot/Strike) + (rate - div + Vol**2 / 2) * T) / (Vol * sqrt_T)
+    d2 = d1 - Vol * sqrt_T
+
+    price = omega * (Spot * torch.exp(-div * T) * torch.special.ndtr(omega * d1)
+                     - Strike * torch.exp(-rate * T) * torch.special.ndtr(omega * d2))
 
+    intrinsic = torch.relu(omega * (Spot - Strike)) + 0.0  # no -0.0 for at the money puts
 
+    return torch.where(alive, price, intrinsic)
 
+
+def BlackScholesGreeksBatch(Spot, Strike, TTM, rate, div, Vol, IsCall):
+    """
+    Price and first and second order sensitivities of a book of options in one pass.
+
+    The gradient and Hessian of each option price with respect to (Spot, Vol) are
+    obtained with a single forward-over-reverse functorch transform vmapped over the
+    whole book, instead of one backward call per option.
+
+    Args:
+    - Spot, Strike, TTM, rate, div, Vol (torch.Tensor): Contract and market data, broadcast together.
+    - IsCall (bool or torch.Tensor): True for call options, False for put options.
+
+    Returns:
+    - dict: 'price', 'delta', 'gamma', 'vega', 'vanna' and 'volga' tensors with the
+      broadcast shape of the inputs.
+    """
+    args = torch.broadcast_tensors(*(torch.as_tensor(a) for a in (Spot, Strike, TTM, rate, div, Vol)),
+                                   torch.as_tensor(IsCall, dtype=torch.bool))
+    shape = args[0].shape
+    Spot, Strike, TTM, rate, div, Vol, IsCall = (a.reshape(-1) for a in args)
+
+    def price(x, K, T, r, q, is_call):
+        p = BlackScholesBatch(x[0], K, T, r, q, x[1], is_call)
+        return p, p
+
+    def first_order(x, K, T, r, q, is_call):
+        grad, p = torch.func.jacrev(price, has_aux=True)(x, K, T, r, q, is_call)
+        return grad, (grad, p)
+
+    second_order = torch.func.jacfwd(first_order, has_aux=True)
+
+    x = torch.stack((Spot, Vol), dim=-1)
+    hess, (grad, p) = torch.func.vmap(second_order)(x, Strike, TTM, rate, div, IsCall)
+
+    return {'price': p.reshape(shape),
+            'delta': grad[:, 0].reshape(shape),
+            'vega': grad[:, 1].reshape(shape),
+            'gamma': hess[:, 0, 0].reshape(shape),
+            'vanna': hess[:, 0, 1].reshape(shape),
+            'volga': hess[:, 1, 1].reshape(shape)}
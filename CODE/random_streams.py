@@ -0,0 +1,149 @@
+import numpy as np
+from scipy.stats import qmc
+from scipy.special import ndtri
+
+
+class RandomStream:
+
+    def __init__(self, seed = None, block_size = 4096, method = 'pseudo', brownian_bridge = True):
+
+        # Reproducible source of standard normals for Monte Carlo paths. Paths are grouped
+        # in fixed blocks of block_size paths and block b always draws from the child
+        # SeedSequence(entropy, spawn_key = (b,)), the same child root.spawn would hand out
+        # in position b. The normals of a path therefore only depend on the seed and on
+        # its index, so a run split across processes by path ranges is bit-identical to
+        # the serial run.
+        #
+        # method:
+        #   'pseudo'      PCG64 normals, generated a block at a time
+        #   'antithetic'  the second half of every block is the first half negated
+        #   'sobol'       scrambled Sobol points, independently scrambled per block
+        #                 (randomized QMC), optionally through a Brownian bridge so the
+        #                 first, best distributed coordinates drive the coarse path shape
+
+        if method not in ('pseudo', 'antithetic', 'sobol'):
+            raise ValueError('Unknown method ' + str(method))
+
+        if method == 'antithetic' and block_size % 2 != 0:
+            raise ValueError('Antithetic streams need an even block size')
+
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.block_size = block_size
+        self.method = method
+        self.brownian_bridge = brownian_bridge
+
+    @property
+    def entropy(self):
+
+        # Enough to rebuild the stream when no seed was given
+        return self.seed_sequence.entropy
+
+    def block_seed(self, block):
+
+        return np.random.SeedSequence(self.seed_sequence.entropy, spawn_key = self.seed_sequence.spawn_key + (block,))
+
+    def generator(self, block):
+
+        return np.random.default_rng(self.block_seed(block))
+
+    def normal_block(self, block, time_grid, num_factors = 1):
+
+        # (block_size, num_factors * (len(time_grid) - 1)) independent N(0, 1), the steps
+        # of factor 0 first, then those of factor 1, ...
+        num_steps = len(time_grid) - 1
+        num_dims = num_factors*num_steps
+
+        if self.method == 'pseudo':
+            return self.generator(block).standard_normal((self.block_size, num_dims))
+
+        if self.method == 'antithetic':
+            half = self.generator(block).standard_normal((self.block_size // 2, num_dims))
+            return np.concatenate((half, -half))
+
+        sobol = qmc.Sobol(num_dims, scramble = True, rng = self.generator(block))
+        u = sobol.random(self.block_size)
+
+        # Scrambled points are never exactly 0 or 1, the clip only guards the tails
+        z = ndtri(np.clip(u, 1e-16, 1 - 1e-16))
+
+        if self.brownian_bridge:
+            z = np.concatenate([brownian_bridge_increments(z[:, f*num_steps:(f+1)*num_steps], time_grid)
+                                for f in range(num_factors)], axis = 1)
+
+        return z
+
+    def normals(self, time_grid, num_paths, start = 0, num_factors = 1):
+
+        # Normals of paths start, ..., start + num_paths - 1, shape (num_paths, num_steps),
+        # or (num_paths, num_factors, num_steps) when several factors are driven. Whole
+        # blocks are generated and sliced, so any partition of the path range gives the
+        # same numbers.
+
+        time_grid = np.asarray(time_grid, dtype = float)
+
+        first = start // self.block_size
+        last = (start + num_paths - 1) // self.block_size
+
+        z = np.concatenate([self.normal_block(b, time_grid, num_factors) for b in range(first, last + 1)])
+
+        offset = start - first*self.block_size
+        z = z[offset:offset + num_paths]
+
+        if num_factors > 1:
+            z = z.reshape(num_paths, num_factors, len(time_grid) - 1)
+
+        return z
+
+    def path_ranges(self, num_paths, num_workers):
+
+        # (start, num_paths) of each worker, cut on block boundaries so no block is
+        # generated twice
+        num_blocks = -(-num_paths // self.block_size)
+        cuts = np.linspace(0, num_blocks, num_workers + 1).round().astype(int) * self.block_size
+        cuts = np.minimum(cuts, num_paths)
+
+        return [(int(a), int(b - a)) for a, b in zip(cuts[:-1], cuts[1:]) if b > a]
+
+
+def brownian_bridge_increments(z, time_grid):
+
+    # Maps i.i.d. normals z (num_paths, num_steps) to the normalized increments
+    # (W(t_j) - W(t_{j-1})) / sqrt(t_j - t_{j-1}) of a Brownian motion built by bridge
+    # construction: column 0 fixes the terminal value, the next columns the midpoints
+    # in breadth first order. The result is again i.i.d. N(0, 1), only the ordering of
+    # the information changes.
+
+    time_grid = np.asarray(time_grid, dtype = float)
+    times = time_grid - time_grid[0]
+    num_steps = len(times) - 1
+
+    W = np.zeros((z.shape[0], num_steps + 1))
+    W[:, -1] = np.sqrt(times[-1]) * z[:, 0]
+
+    column = 1
+    intervals = [(0, num_steps)]
+
+    while intervals:
+
+        next_intervals = []
+
+        for left, right in intervals:
+
+            if right - left < 2:
+                continue
+
+            mid = (left + right) // 2
+
+            t_l, t_m, t_r = times[left], times[mid], times[right]
+
+            mean = ((t_r - t_m)*W[:, left] + (t_m - t_l)*W[:, right]) / (t_r - t_l)
+            std = np.sqrt((t_m - t_l)*(t_r - t_m) / (t_r - t_l))
+
+            W[:, mid] = mean + std*z[:, column]
+            column += 1
+
+            next_intervals += [(left, mid), (mid, right)]
+
+        intervals = next_intervals
+
+    return np.diff(W, axis = 1) / np.sqrt(np.diff(times))
@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+from scipy.linalg import expm, logm
+
+
+class RatingTransitionMatrix:
+
+    def __init__(self, matrix, ratings):
+
+        # matrix is the one year migration matrix, rows are the rating at the start of the
+        # year and columns the rating at the end. The last rating is expected to be the
+        # absorbing default state.
+
+        self.matrix = np.asarray(matrix, dtype = float)
+        self.ratings = list(ratings)
+        self.rating_index = {r: i for i, r in enumerate(self.ratings)}
+
+        self.powers = {1: self.matrix}
+        self.fractional_matrices = {}
+        self.cumulative_matrices = {}
+        self.gen = None
+
+    @classmethod
+    def from_csv(cls, path):
+
+        data = pd.read_csv(path, index_col = 0)
+
+        return cls(data.values, data.columns)
+
+    def power(self, n):
+
+        # n year matrix by exponentiation by squaring. Every power of two and every
+        # requested power is cached, so a range of horizons reuses the products.
+
+        if n in self.powers:
+            return self.powers[n]
+
+        if n == 0:
+            return np.eye(len(self.ratings))
+
+        result = None
+        square, bit = self.matrix, 1
+
+        remaining = n
+        while remaining > 0:
+
+            if remaining & 1:
+                result = square if result is None else result @ square
+
+            remaining >>= 1
+
+            if remaining > 0:
+                bit <<= 1
+                if bit not in self.powers:
+                    self.powers[bit] = square @ square
+                square = self.powers[bit]
+
+        self.powers[n] = result
+
+        return result
+
+    def generator(self):
+
+        # Generator Q such that expm(t Q) gives the t year matrix. The matrix logarithm of an
+        # empirical matrix usually has small negative off-diagonal rates; they are set to zero
+        # and the diagonal adjusted so that rows sum to zero (diagonal adjustment method).
+
+        if self.gen is None:
+
+            gen = np.real(logm(self.matrix))
+
+            off_diagonal = ~np.eye(len(self.ratings), dtype = bool)
+            gen[off_diagonal & (gen < 0)] = 0.0
+            np.fill_diagonal(gen, 0.0)
+            np.fill_diagonal(gen, -gen.sum(axis = 1))
+
+            self.gen = gen
+
+        return self.gen
+
+    def horizon_matrix(self, t):
+
+        # Integer horizons use the exact matrix powers, the rest the generator
+        if float(t).is_integer():
+            return self.power(int(t))
+
+        if t not in self.fractional_matrices:
+            self.fractional_matrices[t] = expm(t * self.generator())
+
+        return self.fractional_matrices[t]
+
+    def cumulative(self, t):
+
+        # Row-wise cumulative probabilities, with the last column forced to one so that
+        # rounding never leaves a uniform draw without a bucket.
+        if t not in self.cumulative_matrices:
+
+            cum = np.cumsum(np.clip(self.horizon_matrix(t), 0.0, None), axis = 1)
+            cum /= cum[:, -1:]
+            cum[:, -1] = 1.0
+
+            self.cumulative_matrices[t] = cum
+
+        return self.cumulative_matrices[t]
+
+    def default_probabilities(self, horizons):
+
+        # (num_ratings, num_horizons) cumulative default probabilities
+        return np.column_stack([self.horizon_matrix(t)[:, -1] for t in horizons])
+
+    def to_index(self, ratings):
+
+        ratings = np.asarray(ratings)
+
+        if ratings.dtype.kind in 'iu':
+            return ratings
+
+        return np.array([self.rating_index[r] for r in ratings.ravel()]).reshape(ratings.shape)
+
+    def simulate(self, initial_ratings, horizons, rng = None):
+
+        # Simulates the rating of every obligor at each horizon (in years, increasing). Each
+        # step draws one uniform per obligor and inverts the cumulative row of its current
+        # rating. All the rows are laid end to end, row r shifted by r, so a single
+        # searchsorted over the flattened matrix inverts every obligor at once.
+        # Returns a (num_obligors, num_horizons) array of rating indices.
+
+        if rng is None:
+            rng = np.random.default_rng()
+
+        state = self.to_index(initial_ratings).astype(int)
+        num_ratings = len(self.ratings)
+
+        paths = np.zeros((len(state), len(horizons)), dtype = int)
+
+        offsets = np.arange(num_ratings)[:, None]
+
+        previous = 0.0
+        for j, t in enumerate(horizons):
+
+            flat_cumulative = (self.cumulative(t - previous) + offsets).ravel()
+
+            u = rng.random(len(state))
+
+            position = np.searchsorted(flat_cumulative, state + u, side = 'right')
+            state = np.minimum(position - state * num_ratings, num_ratings - 1)
+
+            paths[:, j] = state
+            previous = t
+
+        return paths
@@ -0,0 +1,305 @@
+import numpy as np
+
+
+def tail_size(alpha, num_scenarios):
+
+    # Number of worst scenarios in the (1 - alpha) tail, ceil((1 - alpha) * n). The
+    # tolerance stops round off such as (1 - 0.99) * 20000 = 200.00000000000003
+    # from adding a scenario.
+    return max(int(np.ceil((1 - alpha) * num_scenarios * (1 - 1e-12))), 1)
+
+
+def weighted_tail(pl, weights = None, alpha = 0.99):
+
+    # Tail of a P&L sample whose scenarios have probabilities weights (equal if None):
+    # scenario indices sorted from the worst, position in that order of the first
+    # scenario at which the cumulated probability reaches 1 - alpha (the VaR scenario)
+    # and the weights as an array.
+
+    pl = np.asarray(pl, dtype = float).ravel()
+
+    if weights is None:
+        weights = np.full(len(pl), 1.0 / len(pl))
+
+    weights = np.asarray(weights, dtype = float)
+
+    order = np.argsort(pl, kind = 'stable')
+    cum_weights = np.cumsum(weights[order]) / np.sum(weights)
+
+    # Small tolerance so that (1 - alpha) * n scenarios of weight 1/n hit exactly
+    last = min(np.searchsorted(cum_weights, (1 - alpha)*(1 - 1e-12)), len(pl) - 1)
+
+    return order, last, weights
+
+
+def weighted_var_es(pl, weights = None, alpha = 0.99):
+
+    # VaR / ES (losses as positive numbers) of a P&L sample whose scenarios have
+    # probabilities weights (equal if None). VaR is the loss of the first scenario, from
+    # the worst, at which the cumulated probability reaches 1 - alpha, and ES the
+    # probability weighted mean loss up to it, so equal weights give the same figures
+    # as Portfolio_Delta_NPV_Calculator.compute_var_es.
+
+    pl = np.asarray(pl, dtype = float).ravel()
+
+    order, last, weights = weighted_tail(pl, weights, alpha)
+    tail = order[:last+1]
+
+    var = -pl[order[last]]
+    es = -np.sum(weights[tail]*pl[tail]) / np.sum(weights[tail])
+
+    return var, es
+
+
+class TDigest:
+
+    def __init__(self, compression = 500, buffer_size = 10000):
+
+        # Mergeable quantile sketch (merging t-digest). Values are buffered and compressed
+        # into weighted centroids whose size shrinks towards the tails (arcsine scale), so
+        # high quantiles such as PFE 99% keep a small relative error.
+
+        self.compression = compression
+        self.buffer_size = buffer_size
+
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.buffer = []
+        self.buffered = 0
+
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+
+        values = np.asarray(values, dtype = float).ravel()
+
+        if len(values) == 0:
+            return
+
+        self.buffer.append(values)
+        self.buffered += len(values)
+        self.count += len(values)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+        if self.buffered >= self.buffer_size:
+            self.compress()
+
+    def merge(self, other):
+
+        other.compress()
+
+        self.compress()
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+        self.compress(other.means, other.weights)
+
+        return self
+
+    def compress(self, extra_means = None, extra_weights = None):
+
+        means = [self.means] + self.buffer
+        weights = [self.weights] + [np.ones(len(b)) for b in self.buffer]
+
+        if extra_means is not None:
+            means.append(extra_means)
+            weights.append(extra_weights)
+
+        means = np.concatenate(means)
+        weights = np.concatenate(weights)
+
+        self.buffer = []
+        self.buffered = 0
+
+        if len(means) == 0:
+            return
+
+        order = np.argsort(means, kind = 'stable')
+        means, weights = means[order], weights[order]
+
+        total = weights.sum()
+        q = (np.cumsum(weights) - 0.5*weights) / total
+
+        # Points falling in the same unit of the scale function k(q) form one centroid
+        k = np.floor(self.compression / (2*np.pi) * np.arcsin(2*q - 1))
+
+        starts = np.flatnonzero(np.concatenate(([True], k[1:] != k[:-1])))
+
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means*weights, starts) / self.weights
+
+    def quantile(self, q):
+
+        # q in [0, 1], scalar or array
+        self.compress()
+
+        if self.count == 0:
+            return np.full(np.shape(q), np.nan)
+
+        centers = np.cumsum(self.weights) - 0.5*self.weights
+
+        positions = np.concatenate(([0.0], centers, [self.count]))
+        values = np.concatenate(([self.min], self.means, [self.max]))
+
+        return np.interp(np.asarray(q)*self.count, positions, values)
+
+
+class TailBuffer:
+
+    def __init__(self, capacity):
+
+        # Exact buffer of the capacity smallest values seen (worst losses for P&L), with
+        # the number of values seen. Mergeable: the union of two buffers keeps the
+        # smallest values of the union of their streams.
+
+        self.capacity = capacity
+        self.values = np.zeros(0)
+        self.count = 0
+
+    def update(self, values):
+
+        values = np.asarray(values, dtype = float).ravel()
+        self.count += len(values)
+
+        self.values = np.concatenate((self.values, values))
+
+        if len(self.values) > self.capacity:
+            self.values = np.partition(self.values, self.capacity - 1)[:self.capacity]
+
+    def merge(self, other):
+
+        count = self.count + other.count
+        self.update(other.values)
+        self.count = count
+
+        return self
+
+    def worst(self, k):
+
+        if k > len(self.values):
+            raise ValueError('Tail buffer holds ' + str(len(self.values)) + ' values, ' + str(k) + ' requested')
+
+        return np.sort(self.values)[:k]
+
+
+class PnLAccumulator:
+
+    def __init__(self, tail_capacity = 10000, compression = 500):
+
+        # Streaming VaR / ES of a P&L distribution (losses reported as positive numbers).
+        # The tail buffer gives exact figures while ceil((1-alpha) * count) fits in it;
+        # beyond that VaR falls back to the t-digest and ES is not available.
+
+        self.tail = TailBuffer(tail_capacity)
+        self.digest = TDigest(compression)
+        self.sum = 0.0
+        self.sum_sq = 0.0
+
+    @property
+    def count(self):
+        return self.tail.count
+
+    def update(self, pl):
+
+        pl = np.asarray(pl, dtype = float).ravel()
+
+        self.tail.update(pl)
+        self.digest.update(pl)
+        self.sum += pl.sum()
+        self.sum_sq += np.sum(pl**2)
+
+    def merge(self, other):
+
+        self.tail.merge(other.tail)
+        self.digest.merge(other.digest)
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+
+        return self
+
+    def mean(self):
+        return self.sum / self.count
+
+    def std(self):
+        return np.sqrt(self.sum_sq / self.count - self.mean()**2)
+
+    def VaR(self, alpha = 0.99):
+
+        k = tail_size(alpha, self.count)
+
+        if k <= len(self.tail.values):
+            return -self.tail.worst(k)[-1]
+
+        return -self.digest.quantile(1 - alpha)
+
+    def ES(self, alpha = 0.99):
+
+        k = tail_size(alpha, self.count)
+
+        return -np.mean(self.tail.worst(k))
+
+
+class ExposureAccumulator:
+
+    def __init__(self, num_buckets, quantiles = (95,), compression = 500):
+
+        # Per time bucket accumulation of simulated NPVs: EE (mean NPV), EPE (mean positive
+        # exposure), ENE (mean negative exposure) and PFE at several confidence levels
+        # (in percent) from one t-digest of the positive exposure per bucket.
+
+        self.num_buckets = num_buckets
+        self.quantiles = tuple(quantiles)
+
+        self.count = 0
+        self.sum_npv = np.zeros(num_buckets)
+        self.sum_positive = np.zeros(num_buckets)
+        self.sum_negative = np.zeros(num_buckets)
+
+        self.digests = [TDigest(compression) for _ in range(num_buckets)]
+
+    def update(self, NPVs):
+
+        # NPVs has shape (num_paths, num_buckets)
+        NPVs = np.asarray(NPVs, dtype = float)
+
+        positive = np.maximum(NPVs, 0)
+
+        self.count += NPVs.shape[0]
+        self.sum_npv += NPVs.sum(axis = 0)
+        self.sum_positive += positive.sum(axis = 0)
+        self.sum_negative += np.minimum(NPVs, 0).sum(axis = 0)
+
+        for j, digest in enumerate(self.digests):
+            digest.update(positive[:, j])
+
+    def merge(self, other):
+
+        self.count += other.count
+        self.sum_npv += other.sum_npv
+        self.sum_positive += other.sum_positive
+        self.sum_negative += other.sum_negative
+
+        for digest, other_digest in zip(self.digests, other.digests):
+            digest.merge(other_digest)
+
+        return self
+
+    def EE(self):
+        return self.sum_npv / self.count
+
+    def EPE(self):
+        return self.sum_positive / self.count
+
+    def ENE(self):
+        return self.sum_negative / self.count
+
+    def PFE(self, q = None):
+
+        if q is None:
+            return {q: self.PFE(q) for q in self.quantiles}
+
+        return np.array([digest.quantile(q / 100) for digest in self.digests])